@@ -1,54 +1,118 @@
-from pathlib import Path
-import asyncio, json
+import asyncio, os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from uuid import uuid4
-
-from fastapi import FastAPI, UploadFile, Form
-from fastapi.responses import StreamingResponse, FileResponse
+from tempfile import SpooledTemporaryFile
+from fastapi import FastAPI, Form, File, UploadFile
+from fastapi.responses import JSONResponse, StreamingResponse, FileResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
-
+from pathlib import Path
+import orjson
+from typing import Optional, Dict, Any, List
 from scheduler.llm_scheduler import LLMScheduler
 
-app = FastAPI()
-app.add_middleware(CORSMiddleware, allow_origins=["*"])
-sch = LLMScheduler()
+app = FastAPI(title="Multi-Agent Scheduler API")
+scheduler = LLMScheduler()
 
-# ---------- 静态前端 ----------
-BASE_DIR      = Path(__file__).resolve().parent.parent
-FRONTEND_DIR  = BASE_DIR / "frontend"
-app.mount("/static", StaticFiles(directory=FRONTEND_DIR), name="frontend")
+# ---- 调度线程池：大小可由 THREAD_POOL_SIZE 配置 ----
+EXECUTOR = ThreadPoolExecutor(max_workers=int(os.getenv("THREAD_POOL_SIZE", "64")))
 
-@app.get("/")
-async def index():                    # 关键：根路径直接返回 index.html
-    return FileResponse(FRONTEND_DIR / "index.html")
 
-# ---------- SSE ----------
+@app.on_event("startup")
+async def _set_executor():
+    asyncio.get_running_loop().set_default_executor(EXECUTOR)
+
+
+# ---- CORS（跨端口访问时需要） ----
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],        # 生产请写具体域名
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+# ---------- 上传文件：分块读入 SpooledTemporaryFile ----------
+UPLOAD_CHUNK = 1 << 20          # 每次读 1MB
+UPLOAD_SPOOL_MAX = 8 << 20      # 超过 8MB 落盘
+
+
+async def read_upload(file: Optional[UploadFile]) -> Optional[SpooledTemporaryFile]:
+    """分块读取上传文件，内存占用与文件大小无关；空文件视为未上传。"""
+    if not file:
+        return None
+    buf = SpooledTemporaryFile(max_size=UPLOAD_SPOOL_MAX)
+    while chunk := await file.read(UPLOAD_CHUNK):
+        buf.write(chunk)
+    if not buf.tell():
+        buf.close()
+        return None
+    buf.seek(0)
+    return buf
+
+
+# ---------- 端点 1：一次性 JSON ----------
+@app.post("/submit_task")
+async def submit_task(text: str = Form(""), file: Optional[UploadFile] = File(None)):
+    pdf = await read_upload(file)
+    events: List[Dict[str, Any]] = []
+
+    # 调度器只通过回调产出结果：在线程池里跑完，收集全部事件后一次返回
+    await asyncio.get_running_loop().run_in_executor(None, partial(
+        scheduler.dispatch,
+        f"ctx_{uuid4().hex}",
+        text,
+        pdf_bytes=pdf,
+        progress_cb=events.append
+    ))
+    return JSONResponse({"events": events})
+
+
+# ---------- 端点 2：Server-Sent Events（流式） ----------
 @app.post("/submit_task_stream")
-async def submit_task_stream(text: str = Form(""), file: UploadFile | None = None):
+async def submit_task_stream(text: str = Form(""), file: Optional[UploadFile] = File(None)):
+    pdf = await read_upload(file)
+    queue: "asyncio.Queue[Dict[str, Any]]" = asyncio.Queue()
+
+    # 每次生成唯一的 context_id
+    ctx_id = f"ctx_{uuid4().hex}"
 
-    pdf = await file.read() if file else None
-    q   = asyncio.Queue()
+    # 获取当前事件循环
     loop = asyncio.get_running_loop()
 
-    def push(msg): loop.call_soon_threadsafe(q.put_nowait, msg)
+    # 回调：调度器每有进度就丢进队列
+    def push_progress(payload: Dict[str, Any]):
+        # 把 payload 丢回主循环中的 queue
+        loop.call_soon_threadsafe(queue.put_nowait, payload)
 
-    asyncio.create_task(asyncio.to_thread(
-        sch.dispatch, f"ctx_{uuid4().hex}", text,
-        pdf_bytes=pdf, progress_cb=push
+    # 在线程池跑调度器（run_in_executor 不复制 contextvars，开销低于 to_thread）
+    loop.run_in_executor(None, partial(
+        scheduler.dispatch,
+        ctx_id,                       # 动态生成的 context_id
+        text,
+        pdf_bytes=pdf,
+        progress_cb=push_progress
     ))
 
     async def event_gen():
         while True:
-            msg = await q.get()
-            yield f"data: {json.dumps(msg, ensure_ascii=False)}\n\n"
-            if msg.get("type") == "chat_file":
+            payload = await queue.get()
+            yield b"data: " + orjson.dumps(payload) + b"\n\n"
+            if payload.get("type") == "chat_file":
                 break
 
     return StreamingResponse(event_gen(), media_type="text/event-stream")
 
 
+# ---------- 静态前端 ----------
+frontend_dir = Path(__file__).resolve().parent.parent / "frontend"
+app.mount("/static", StaticFiles(directory=frontend_dir, html=True), name="frontend")
+
+@app.get("/")
+async def index():
+    return FileResponse(frontend_dir / "index.html")
+
+
 if __name__ == "__main__":            # 直接 python coordinator/server.py 也能跑
     import uvicorn
-    uvicorn.run("coordinator.server:app",
-                host="0.0.0.0", port=8080, reload=True)
-
+    uvicorn.run("coordinator.server:app", host="0.0.0.0", port=8080, reload=True)
@@ -20,3 +20,12 @@ class MemoryStore:
         """
         return self.store.get(context_id, {})
 
+    def append(self, context_id, agent, key, value):
+        """
+        在指定任务的某个 agent 名下写入一条记录，避免先 get 再整体 update。
+        :param context_id: 任务的唯一标识符
+        :param agent: agent 名称
+        :param key: 记录键（如子任务名）
+        :param value: 记录值
+        """
+        self.store.setdefault(context_id, {}).setdefault(agent, {})[key] = value
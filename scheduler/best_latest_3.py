@@ -239,11 +239,18 @@ class LLMScheduler:
             for ag, mem in self.memory.get(context_id).items()
             if ag in REGISTRY
         )
-        rsp = client.chat.completions.create(
+        # 流式汇总：每段增量即推给前端，流结束立刻写回 memory
+        buf: List[str] = []
+        for chunk in client.chat.completions.create(
             model="gpt-4o",
-            messages=[{"role": "user", "content": "请综合以下各智能体输出，并用 Markdown 返回：\n" + collected}]
-        )
-        summary_md = rsp.choices[0].message.content.strip()
+            messages=[{"role": "user", "content": "请综合以下各智能体输出，并用 Markdown 返回：\n" + collected}],
+            stream=True
+        ):
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                buf.append(delta)
+                self._push(progress_cb, {"status": "summary_delta", "delta": delta})
+        summary_md = "".join(buf).strip()
         self.memory.update(context_id, {"summary": summary_md})
         self.trace.append({"agent": "scheduler", "subtask": "自动总结", "output": summary_md})
 
@@ -1,17 +1,32 @@
-import os, json, requests
-from typing import List, Dict, Tuple, Optional, Callable, Any
+import os, re, json, asyncio, hashlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import List, Dict, Tuple, Optional, Callable, Any, Iterator, IO, Union
 
 import fitz  # PyMuPDF
+import httpx
 from openai import OpenAI
 from mcp.memory import MemoryStore
+from scheduler.llm_cache import cached_chat, cached_chat_stream, PLAN_TTL, ANSWER_TTL
 
 try:
-    from pdf2image import convert_from_bytes
-    import pytesseract
+    import tesserocr        # 进程内 OCR：tessdata 常驻，免去每页 fork tesseract
+except ImportError:
+    tesserocr = None
+
+try:
+    from PIL import Image
+    if tesserocr is None:
+        import pytesseract
     OCR_AVAILABLE = True
 except ImportError:
     OCR_AVAILABLE = False
 
+try:
+    import zstandard
+    ZSTD_AVAILABLE = True
+except ImportError:
+    ZSTD_AVAILABLE = False
+
 # ---------- OpenAI ----------
 client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
@@ -21,6 +36,117 @@ REGISTRY: Dict[str, str] = {
     "llama2_agent_2": "http://142.214.185.187:30934/infer",
 }
 
+# ---------- PDF 输入 ----------
+PdfInput = Union[bytes, IO[bytes]]
+
+
+def _as_bytes(data: PdfInput) -> bytes:
+    """上传内容可能是 bytes，也可能是服务端分块写入的文件对象（SpooledTemporaryFile）。"""
+    return data.read() if hasattr(data, "read") else data
+
+
+# ---------- PDF 解析缓存：每页一个 zstd 压缩的 sidecar ----------
+# 目录结构：{PDF_CACHE_DIR}/{sha256}/{页码}.zst，外加最后写入的页数文件 pages
+PDF_CACHE_DIR = os.getenv("PDF_CACHE_DIR", "./cache/pdfpages")
+_PAGE_EXT = ".zst" if ZSTD_AVAILABLE else ".txt"
+
+
+def _write_atomic(path: str, raw: bytes):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(raw)
+        os.replace(tmp, path)
+    except OSError:
+        pass
+
+
+def _load_cached_page(digest: str, idx: int) -> Optional[str]:
+    try:
+        with open(os.path.join(PDF_CACHE_DIR, digest, f"{idx}{_PAGE_EXT}"), "rb") as f:
+            raw = f.read()
+        if ZSTD_AVAILABLE:
+            raw = zstandard.ZstdDecompressor().decompress(raw)
+        return raw.decode("utf-8")
+    except Exception:
+        return None
+
+
+def _save_cached_page(digest: str, idx: int, txt: str):
+    raw = txt.encode("utf-8")
+    if ZSTD_AVAILABLE:
+        raw = zstandard.ZstdCompressor().compress(raw)
+    _write_atomic(os.path.join(PDF_CACHE_DIR, digest, f"{idx}{_PAGE_EXT}"), raw)
+
+
+def _load_pdf_cache(digest: str) -> Optional[List[Tuple[str, str]]]:
+    """整份 PDF 都已缓存时返回全部页面，否则返回 None。"""
+    try:
+        with open(os.path.join(PDF_CACHE_DIR, digest, "pages"), "rb") as f:
+            n = int(f.read())
+    except Exception:
+        return None
+    pages: List[Tuple[str, str]] = []
+    for idx in range(1, n + 1):
+        txt = _load_cached_page(digest, idx)
+        if txt is None:
+            return None
+        pages.append((f"page_{idx}", txt))
+    return pages
+
+
+def _finish_pdf_cache(digest: str, n: int):
+    _write_atomic(os.path.join(PDF_CACHE_DIR, digest, "pages"), str(n).encode())
+
+
+def _page_no(pid: str) -> int:
+    return int(pid.rsplit("_", 1)[1])
+
+
+# ---------- 页面分配解析 ----------
+_PAGE_RE = re.compile(r"([A-Za-z_]*)(\d+)")
+
+
+# ---------- 拆分判断启发式 ----------
+_SPLIT_MARKERS_RE = re.compile(r"(步骤|分别|首先|其次|以及|然后)")
+
+
+# ---------- OCR ----------
+OCR_LANG = "eng+chi_sim"
+OCR_CONFIG = "--oem 1 --psm 6"     # LSTM-only 快速模式
+
+
+_tess = None     # 每个 worker 进程持有一个 PyTessBaseAPI
+
+
+def _ocr_init():
+    global _tess
+    if tesserocr is not None:
+        _tess = tesserocr.PyTessBaseAPI(
+            lang=OCR_LANG, oem=tesserocr.OEM.LSTM_ONLY, psm=tesserocr.PSM.SINGLE_BLOCK
+        )
+
+
+def _ocr_image(img) -> str:
+    # 顶层函数，供 ProcessPoolExecutor pickle
+    if _tess is not None:
+        _tess.SetImage(img)
+        return _tess.GetUTF8Text()
+    return pytesseract.image_to_string(img, lang=OCR_LANG, config=OCR_CONFIG)
+
+
+# ---------- Agent HTTP ----------
+AGENT_TIMEOUT = 120
+AGENT_LIMITS = httpx.Limits(max_connections=64, max_keepalive_connections=32)
+AGENT_RETRIES = 2        # 仅重试建连失败
+
+
+def _agent_client() -> httpx.AsyncClient:
+    """一次 dispatch 内所有 agent 调用共用的连接池（keep-alive 复用）。"""
+    transport = httpx.AsyncHTTPTransport(limits=AGENT_LIMITS, retries=AGENT_RETRIES)
+    return httpx.AsyncClient(transport=transport, timeout=AGENT_TIMEOUT)
+
 # ------------------------------------------------------------
 
 
@@ -34,39 +160,76 @@ class LLMScheduler:
 
     def __init__(self):
         self.memory = MemoryStore()
-        self.trace: List[Dict[str, Any]] = []
 
     # ---------- PDF → pages ----------
     @staticmethod
-    def _pdf_pages(data: bytes) -> List[Tuple[str, str]]:
-        pages: List[Tuple[str, str]] = []
-        doc = fitz.open(stream=data, filetype="pdf")
-        for idx, page in enumerate(doc, 1):
-            txt = page.get_text("text") or ""
-            if not txt.strip() and OCR_AVAILABLE:
-                img = convert_from_bytes(data, dpi=300, first_page=idx, last_page=idx)[0]
-                txt = pytesseract.image_to_string(img, lang="eng+chi_sim")
-            pages.append((f"page_{idx}", txt.strip()))
+    def _pdf_pages(data: PdfInput) -> List[Tuple[str, str]]:
+        data = _as_bytes(data)
+        digest = hashlib.sha256(data).hexdigest()
+        pages = _load_pdf_cache(digest)
+        if pages is None:
+            pages = LLMScheduler._extract_pages(data, digest)
+        return pages
+
+    @staticmethod
+    def _extract_pages(data: bytes, digest: Optional[str] = None) -> List[Tuple[str, str]]:
+        pages = list(LLMScheduler._iter_pdf_pages(data, digest))
+        pages.sort(key=lambda p: _page_no(p[0]))
         return pages
 
+    @staticmethod
+    def _iter_pdf_pages(data: bytes, digest: Optional[str] = None) -> Iterator[Tuple[str, str]]:
+        """
+        逐页产出 (page_id, text)，不保证页序：
+        已有 sidecar 的页面直接读缓存；有文本层的页面立即产出；
+        无文本层的页面交给 OCR 进程池，识别完成即产出。
+        传入 digest 时每页结果写入 sidecar，全部完成后写页数文件。
+        """
+        doc = fitz.open(stream=data, filetype="pdf")
+        ex: Optional[ProcessPoolExecutor] = None
+        ocr_futs = {}
+        try:
+            for idx, page in enumerate(doc, 1):
+                cached = _load_cached_page(digest, idx) if digest else None
+                if cached is not None:
+                    yield f"page_{idx}", cached
+                    continue
+                txt = page.get_text("text") or ""
+                if txt.strip() or not OCR_AVAILABLE:
+                    txt = txt.strip()
+                    if digest:
+                        _save_cached_page(digest, idx, txt)
+                    yield f"page_{idx}", txt
+                    continue
+                if ex is None:
+                    ex = ProcessPoolExecutor(max_workers=os.cpu_count() or 1, initializer=_ocr_init)
+                ocr_futs[ex.submit(_ocr_image, LLMScheduler._render_page(page))] = idx
+            for fut in as_completed(ocr_futs):
+                idx, txt = ocr_futs[fut], fut.result().strip()
+                if digest:
+                    _save_cached_page(digest, idx, txt)
+                yield f"page_{idx}", txt
+            if digest:
+                _finish_pdf_cache(digest, len(doc))
+        finally:
+            if ex is not None:
+                ex.shutdown(cancel_futures=True)
+
+    @staticmethod
+    def _render_page(page, dpi: int = 300):
+        # 直接渲染灰度图：tesseract 本身只用灰度，且传给 OCR 进程的数据量减为 1/3
+        pix = page.get_pixmap(dpi=dpi, colorspace=fitz.csGRAY)
+        return Image.frombytes("L", (pix.width, pix.height), pix.samples)
+
     # ---------- 判断是否需要拆分 ----------
-    def _need_split(self, task: str) -> bool:
-        rsp = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {
-                    "role": "system",
-                    "content": (
-                        "你是任务复杂度评估器，仅回答 'yes' 或 'no'。"
-                        "当且仅当【任务】需要被拆分为子任务才能高效完成时回答 'yes'，"
-                        "否则回答 'no'。"
-                    ),
-                },
-                {"role": "user", "content": f"【任务】{task}"},
-            ],
-            max_tokens=1,
-        )
-        return rsp.choices[0].message.content.strip().lower().startswith("y")
+    @staticmethod
+    def _need_split_fast(task: str) -> Optional[bool]:
+        """明显的情况直接给出结论；拿不准返回 None，交给 GPT-4o。"""
+        if len(task) > 3000 or len(_SPLIT_MARKERS_RE.findall(task)) >= 2:
+            return True
+        if len(task) < 400 and task.count("。") + task.count(".") <= 2:
+            return False
+        return None
 
     # ---------- GPT-4o 页面分配 ----------
     def _plan_pages(self, task: str, page_ids: List[str]) -> Dict[str, List[str]]:
@@ -76,14 +239,17 @@ class LLMScheduler:
             + ", ".join(REGISTRY.keys()) +
             "。格式：agent: id1,id2 或 agent: m-n。仅返回分配结果。"
         )
-        rsp = client.chat.completions.create(
+        content = cached_chat(
+            client, PLAN_TTL,
             model="gpt-4o",
             messages=[
                 {"role": "system", "content": sys_msg},
                 {"role": "user",   "content": f"【任务】{task}\n【页面列表】{ids_str}"},
             ],
+            temperature=0,
+            seed=0,
         )
-        return self._parse_page_plan(rsp.choices[0].message.content)
+        return self._parse_page_plan(content)
 
     # ---------- GPT-4o 解析页面分配 ----------
     @staticmethod
@@ -101,46 +267,57 @@ class LLMScheduler:
                 if not part:
                     continue
                 if "-" in part:
-                    s, e = part.split("-")
-                    s_idx = int("".join(filter(str.isdigit, s)))
-                    e_idx = int("".join(filter(str.isdigit, e)))
-                    prefix = "".join(filter(str.isalpha, s)) or "page_"
-                    plan[ag] += [f"{prefix}{i}" for i in range(s_idx, e_idx + 1)]
+                    s, e = part.split("-", 1)
+                    ms, me = _PAGE_RE.match(s), _PAGE_RE.match(e)
+                    if not (ms and me):
+                        continue
+                    prefix = ms.group(1) or "page_"
+                    plan[ag] += [f"{prefix}{i}" for i in range(int(ms.group(2)), int(me.group(2)) + 1)]
                 else:
-                    plan[ag].append(part)
+                    m = _PAGE_RE.match(part)
+                    if m:
+                        plan[ag].append(f"{m.group(1) or 'page_'}{m.group(2)}")
         return {k: v for k, v in plan.items() if v}
 
-    # ---------- GPT-4o JSON 拆任务 ----------
-    def _plan_subtasks_json(self, task: str) -> Dict[str, List[str]]:
+    # ---------- GPT-4o 一次完成：是否拆分 + JSON 拆任务 ----------
+    def _plan_once(self, task: str) -> Tuple[bool, Dict[str, List[str]]]:
         sys_msg = (
-            "你是任务调度专家。把【任务】拆成多个可并行子任务，并分配给以下 agent："
+            "你是任务调度专家。先判断【任务】是否需要拆分为多个可并行子任务才能高效完成；"
+            "若需要，再拆分并分配给以下 agent："
             + ", ".join(REGISTRY.keys()) +
-            "。\n直接用 JSON 对象回复，不要写多余文字，格式示例：\n"
-            '{ "llama2_agent": ["任务1", "任务2"], "llama2_agent_2": ["任务3"] }'
+            "。\n直接用 JSON 对象回复，不要写多余文字，split 为 no 时 plan 可为空，格式示例：\n"
+            '{ "split": "yes", "plan": { "llama2_agent": ["任务1", "任务2"], "llama2_agent_2": ["任务3"] } }'
         )
-        rsp = client.chat.completions.create(
+        content = cached_chat(
+            client, PLAN_TTL,
             model="gpt-4o",
             messages=[
                 {"role": "system", "content": sys_msg},
                 {"role": "user",   "content": f"【任务】{task}"},
             ],
-            response_format={"type": "json_object"}
+            response_format={"type": "json_object"},
+            temperature=0,
+            seed=0,
         )
         try:
-            data = json.loads(rsp.choices[0].message.content)
+            data = json.loads(content)
         except Exception:
-            return {}
-        return {k: v for k, v in data.items() if k in REGISTRY and isinstance(v, list)}
+            return False, {}
+        split = str(data.get("split", "")).strip().lower().startswith(("y", "t"))
+        plan = data.get("plan") or {}
+        if not isinstance(plan, dict):
+            return split, {}
+        return split, {k: v for k, v in plan.items() if k in REGISTRY and isinstance(v, list)}
 
     # ---------- 简单任务回答 ----------
     def _answer_direct(self, text: str, progress_cb):
-        rsp = client.chat.completions.create(
+        md = cached_chat(
+            client, ANSWER_TTL,
             model="gpt-4o",
             messages=[{"role": "user", "content": f"请以 Markdown 格式完整回答：\n\n{text.strip()}"}],
-        )
-        md = rsp.choices[0].message.content.strip()
+        ).strip()
         self._push(progress_cb, {"status": "done", "markdown": md})
-        return {"markdown": md, "trace": self.trace}
+        return {"markdown": md, "trace": []}
 
     # ---------- push helper ----------
     @staticmethod
@@ -148,43 +325,146 @@ class LLMScheduler:
         if cb:
             cb(payload)
 
+    # ---------- 单个 agent 调用 ----------
+    async def _call_agent(
+        self,
+        http: httpx.AsyncClient,
+        context_id: str,
+        snapshot: Dict[str, Any],
+        ag: str,
+        key: str,
+        prompt: str,
+        progress_cb: Optional[Callable[[Dict[str, Any]], None]],
+    ) -> str:
+        payload = {
+            "prompt": prompt,
+            "context_id": context_id,
+            "sub_id": key,
+            "agent_name": ag,
+            "shared_memory": snapshot,
+        }
+        try:
+            resp = await http.post(REGISTRY[ag], json=payload)
+            res_text = resp.json().get("result", "")
+        except Exception as e:
+            res_text = f"[❌ 调用失败] {e}"
+        self._push(progress_cb,
+                   {"status": "result", "agent": ag, "subtask": f"Process {key}", "output": res_text})
+        return res_text
+
+    # ---------- 并发调用全部 agent ----------
+    async def _call_agents(
+        self,
+        context_id: str,
+        jobs: List[Tuple[str, str]],
+        make_prompt: Callable[[str], str],
+        progress_cb: Optional[Callable[[Dict[str, Any]], None]],
+    ) -> List[str]:
+        snapshot = self.memory.get(context_id)
+        async with _agent_client() as http:
+            return await asyncio.gather(*[
+                self._call_agent(http, context_id, snapshot, ag, key, make_prompt(key), progress_cb)
+                for ag, key in jobs
+            ])
+
+    # ---------- PDF 流水线：边解析边分发 ----------
+    async def _stream_pdf(
+        self,
+        context_id: str,
+        task: str,
+        data: bytes,
+        digest: str,
+        progress_cb: Optional[Callable[[Dict[str, Any]], None]],
+    ) -> Tuple[List[Tuple[str, str]], List[str]]:
+        """
+        解析线程逐页把结果放进队列；每拿到一页就按 Round-Robin 选 agent 并立即发起调用。
+        返回按页序排列的 (jobs, results)。
+        """
+        loop = asyncio.get_running_loop()
+        queue: "asyncio.Queue[Optional[Tuple[str, str]]]" = asyncio.Queue()
+        agents = list(REGISTRY)
+        snapshot = self.memory.get(context_id)
+        jobs: List[Tuple[str, str]] = []
+        calls = []
+
+        def produce():
+            try:
+                for page in self._iter_pdf_pages(data, digest):
+                    loop.call_soon_threadsafe(queue.put_nowait, page)
+            finally:
+                loop.call_soon_threadsafe(queue.put_nowait, None)
+
+        producer = loop.run_in_executor(None, produce)
+        async with _agent_client() as http:
+            while (page := await queue.get()) is not None:
+                pid, txt = page
+                ag = agents[len(jobs) % len(agents)]
+                jobs.append((ag, pid))
+                sub_name = f"Process {pid}"
+                self._push(progress_cb, {"status": "subtasks", "subtasks": [sub_name]})
+                self._push(progress_cb,
+                           {"status": "assign", "agent": ag, "subtask": sub_name, "output": "Processing"})
+                prompt = f"【任务指令】{task}\n\n【{pid} 原文】\n{txt}"
+                calls.append(asyncio.create_task(
+                    self._call_agent(http, context_id, snapshot, ag, pid, prompt, progress_cb)
+                ))
+            await producer
+            results = await asyncio.gather(*calls)
+
+        order = sorted(range(len(jobs)), key=lambda i: _page_no(jobs[i][1]))
+        return [jobs[i] for i in order], [results[i] for i in order]
+
     # ---------- dispatch ----------
     def dispatch(
         self,
         context_id: str,
         task: str,
-        pdf_bytes: Optional[bytes] = None,
-        file_bytes: Optional[bytes] = None,
+        pdf_bytes: Optional[PdfInput] = None,
+        file_bytes: Optional[PdfInput] = None,
         plain_text: Optional[str] = None,
         progress_cb: Optional[Callable[[Dict[str, Any]], None]] = None,
     ) -> Dict[str, Any]:
 
         pdf_data = pdf_bytes or file_bytes
+        if pdf_data is not None:
+            pdf_data = _as_bytes(pdf_data)
 
         # -------- PDF 任务 --------
+        jobs: List[Tuple[str, str]] = []
+        results: List[str] = []
+        sub_ids_source: Dict[str, List[str]] = {}
         if pdf_data:
-            pages = self._pdf_pages(pdf_data)
-            page_ids = [pid for pid, _ in pages]
-            self._push(progress_cb, {
-                "status": "subtasks",
-                "subtasks": [f"Process {pid}" for pid in page_ids]
-            })
-            plan = self._plan_pages(task, page_ids)
-            if not plan:   # fallback Round-Robin
-                plan = {ag: [] for ag in REGISTRY}
-                for idx, pid in enumerate(page_ids):
-                    plan[list(REGISTRY)[idx % len(REGISTRY)]].append(pid)
-            page_map = dict(pages)
-            make_prompt = lambda pid: f"【任务指令】{task}\n\n【{pid} 原文】\n{page_map.get(pid,'')}"
-            sub_ids_source = plan
+            digest = hashlib.sha256(pdf_data).hexdigest()
+            pages = _load_pdf_cache(digest)
+            if pages is None:
+                # 未命中缓存：解析与 agent 调用重叠进行（Round-Robin 分配）
+                jobs, results = asyncio.run(
+                    self._stream_pdf(context_id, task, pdf_data, digest, progress_cb)
+                )
+            else:
+                # 命中缓存：页面即刻可得，交给 GPT-4o 按能力分配
+                page_ids = [pid for pid, _ in pages]
+                self._push(progress_cb, {
+                    "status": "subtasks",
+                    "subtasks": [f"Process {pid}" for pid in page_ids]
+                })
+                plan = self._plan_pages(task, page_ids)
+                if not plan:   # fallback Round-Robin
+                    plan = {ag: [] for ag in REGISTRY}
+                    for idx, pid in enumerate(page_ids):
+                        plan[list(REGISTRY)[idx % len(REGISTRY)]].append(pid)
+                page_map = dict(pages)
+                make_prompt = lambda pid: f"【任务指令】{task}\n\n【{pid} 原文】\n{page_map.get(pid,'')}"
+                sub_ids_source = plan
 
         # -------- 纯文本 / 指令 --------
         else:
-            if not self._need_split(task):
+            need_split = self._need_split_fast(task)
+            if need_split is False:
                 return self._answer_direct(task, progress_cb)
 
-            plan = self._plan_subtasks_json(task)
-            if not plan:  # 拆解失败 → 简单回答
+            split, plan = self._plan_once(task)
+            if not (split or need_split) or not plan:  # 无需拆分 / 拆解失败 → 简单回答
                 return self._answer_direct(task, progress_cb)
 
             all_subs = [sub for lst in plan.values() for sub in lst]
@@ -195,47 +475,45 @@ class LLMScheduler:
             make_prompt = lambda sub: f"【总任务】{task}\n\n【子任务描述】{sub}"
             sub_ids_source = plan
 
-        # ---------- 调用各 agent ----------
-        for ag, keys in sub_ids_source.items():
-            for key in keys:
-                sub_name = f"Process {key}"
+        # ---------- 调用各 agent（并发；流式 PDF 已在上面完成） ----------
+        if sub_ids_source:
+            jobs = [(ag, key) for ag, keys in sub_ids_source.items() for key in keys]
+            for ag, key in jobs:
                 self._push(progress_cb,
-                           {"status": "assign", "agent": ag, "subtask": sub_name, "output": "Processing"})
-                payload = {
-                    "prompt": make_prompt(key),
-                    "context_id": context_id,
-                    "sub_id": key,
-                    "agent_name": ag,
-                    "shared_memory": self.memory.get(context_id),
-                }
-                try:
-                    resp = requests.post(REGISTRY[ag], json=payload, timeout=120)
-                    res_text = resp.json().get("result", "")
-                except Exception as e:
-                    res_text = f"[❌ 调用失败] {e}"
-
-                ag_mem = self.memory.get(context_id).get(ag, {}) or {}
-                ag_mem[sub_name] = res_text
-                self.memory.update(context_id, {ag: ag_mem})
-                self.trace.append({"agent": ag, "subtask": sub_name, "output": res_text})
+                           {"status": "assign", "agent": ag, "subtask": f"Process {key}", "output": "Processing"})
+            results = asyncio.run(self._call_agents(context_id, jobs, make_prompt, progress_cb))
+
+        # 按计划顺序写回 memory / trace，保证汇总顺序稳定（trace 为本次请求私有）
+        trace: List[Dict[str, Any]] = []
+        for (ag, key), res_text in zip(jobs, results):
+            sub_name = f"Process {key}"
+            self.memory.append(context_id, ag, sub_name, res_text)
+            trace.append({"agent": ag, "subtask": sub_name, "output": res_text})
 
         # ---------- 汇总 ----------
-        collected = "\n\n".join(
-            f"【{ag}】\n" + "\n".join(mem.values())
-            for ag, mem in self.memory.get(context_id).items()
-            if ag in REGISTRY
-        )
-        rsp = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[{
-                "role": "user",
-                "content": "请综合以下各智能体输出，进行总结。并用 Markdown 返回汇总后结果：\n" + collected
-            }]
-        )
-        summary_md = rsp.choices[0].message.content.strip()
+        if len(jobs) == 1:
+            # 只有一个子任务：其输出即最终结果，省去一次 GPT-4o 汇总
+            summary_md = results[0].strip()
+        else:
+            parts: List[str] = []
+            for ag, mem in self.memory.get(context_id).items():
+                if ag in REGISTRY:
+                    parts += ["", f"【{ag}】"] if parts else [f"【{ag}】"]
+                    parts += mem.values()
+            collected = "\n".join(parts)
+            summary_md = cached_chat_stream(
+                client,
+                lambda delta: self._push(progress_cb, {"status": "summary_delta", "delta": delta}),
+                ANSWER_TTL,
+                model="gpt-4o",
+                messages=[{
+                    "role": "user",
+                    "content": "请综合以下各智能体输出，进行总结。并用 Markdown 返回汇总后结果：\n" + collected
+                }]
+            ).strip()
         self.memory.update(context_id, {"summary": summary_md})
-        self.trace.append({"agent": "scheduler", "subtask": "自动总结", "output": summary_md})
+        trace.append({"agent": "scheduler", "subtask": "自动总结", "output": summary_md})
 
         self._push(progress_cb, {"status": "done", "markdown": summary_md})
-        return {"markdown": summary_md, "trace": self.trace}
+        return {"markdown": summary_md, "trace": trace}
 
@@ -0,0 +1,434 @@
+import os, json, time, asyncio, hashlib, inspect, sqlite3, threading
+from collections import OrderedDict
+from functools import wraps
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+try:
+    import redis
+    REDIS_AVAILABLE = True
+except ImportError:
+    REDIS_AVAILABLE = False
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+# ---------- 配置 ----------
+L1_MAXSIZE = 4096
+PLAN_TTL = 3600            # 规划 / 判断类调用：1h
+ANSWER_TTL = 24 * 3600     # 直接回答 / 汇总：24h
+# 落盘缓存默认放在仓库根目录的 cache/，与启动时的工作目录无关；LLM_CACHE_DIR 可整体改位置
+CACHE_DIR = os.getenv("LLM_CACHE_DIR") or os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "cache")
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", os.path.join(CACHE_DIR, "llm.sqlite3"))   # 未配置 Redis 时的落盘 L2
+
+PLAN_CACHE_PATH = os.getenv("PLAN_CACHE_PATH", os.path.join(CACHE_DIR, "plans.sqlite3"))
+PLAN_CACHE_MAX = 500       # 超出后按 LFU 淘汰
+PLAN_SIM_THRESHOLD = 0.9   # 页面分配规划：余弦相似度 ≥ 该值视为同一任务
+RESPONSE_SIM_THRESHOLD = 0.92   # v4–v8 规划调用的语义命中阈值
+EMBED_MODEL = "text-embedding-3-small"
+
+AGENT_CACHE_PATH = os.getenv("AGENT_CACHE_PATH", os.path.join(CACHE_DIR, "agents.sqlite3"))
+AGENT_CACHE_MAX = 5000
+AGENT_SIM_THRESHOLD = 0.92
+AGENT_TTL = ANSWER_TTL     # agent 子任务结果的有效期
+
+
+class LLMCache:
+    """
+    LLM 响应缓存：
+    - L1：进程内 LRU（带过期时间），线程安全。
+    - L2：可选 Redis（设置环境变量 REDIS_URL 且安装 redis 时启用）；
+          未启用 Redis 时退回本地 sqlite（LLM_CACHE_PATH，置空则关闭），重启 / 重放后仍可命中；
+          sqlite 在首次读写时才打开，import 本模块不会创建文件。
+    key 为请求参数的 SHA-256，value 为模型返回的文本。
+    """
+
+    def __init__(self, maxsize: int = L1_MAXSIZE, redis_url: Optional[str] = None,
+                 db_path: Optional[str] = LLM_CACHE_PATH):
+        self.maxsize = maxsize
+        self._l1: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._l2 = None
+        self._db = None
+        self._db_path = None
+        redis_url = redis_url or os.getenv("REDIS_URL")
+        if redis_url and REDIS_AVAILABLE:
+            self._l2 = redis.Redis.from_url(redis_url)     # 只解析 URL，首次命令时才建连
+        elif db_path:
+            self._db_path = db_path
+
+    def _conn(self) -> Optional[sqlite3.Connection]:
+        """按需打开落盘 L2；调用方不得持有 self._lock。"""
+        if self._db is None and self._db_path:
+            with self._lock:
+                if self._db is None:
+                    if self._db_path != ":memory:":
+                        os.makedirs(os.path.dirname(self._db_path) or ".", exist_ok=True)
+                    db = sqlite3.connect(self._db_path, check_same_thread=False)
+                    db.execute("CREATE TABLE IF NOT EXISTS llm (key TEXT PRIMARY KEY, value TEXT, expire REAL)")
+                    db.commit()
+                    self._db = db
+        return self._db
+
+    @staticmethod
+    def make_key(**kwargs: Any) -> str:
+        raw = json.dumps(kwargs, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            hit = self._l1.get(key)
+            if hit:
+                expire, value = hit
+                if expire > now:
+                    self._l1.move_to_end(key)
+                    return value
+                del self._l1[key]
+        if self._l2 is not None:
+            try:
+                # 同一往返取值与剩余有效期，回填 L1 时不超过 Redis 中的过期时间
+                raw, ttl = self._l2.pipeline().get(f"llm:{key}").ttl(f"llm:{key}").execute()
+            except Exception:
+                raw = None
+            if raw is not None:
+                value = raw.decode("utf-8")
+                if ttl > 0:
+                    self._set_l1(key, value, ttl)
+                return value
+        db = self._conn()
+        if db is not None:
+            with self._lock:
+                row = db.execute("SELECT value, expire FROM llm WHERE key=?", (key,)).fetchone()
+            if row and row[1] > now:
+                self._set_l1(key, row[0], int(row[1] - now))
+                return row[0]
+        return None
+
+    def set(self, key: str, value: str, ttl: int = PLAN_TTL):
+        self._set_l1(key, value, ttl)
+        if self._l2 is not None:
+            try:
+                self._l2.set(f"llm:{key}", value.encode("utf-8"), ex=ttl)
+            except Exception:
+                pass
+        db = self._conn()
+        if db is not None:
+            now = time.time()
+            with self._lock:
+                db.execute("DELETE FROM llm WHERE expire <= ?", (now,))
+                db.execute("INSERT OR REPLACE INTO llm VALUES (?, ?, ?)", (key, value, now + ttl))
+                db.commit()
+
+    def _set_l1(self, key: str, value: str, ttl: int):
+        with self._lock:
+            self._l1[key] = (time.time() + ttl, value)
+            self._l1.move_to_end(key)
+            while len(self._l1) > self.maxsize:
+                self._l1.popitem(last=False)
+
+
+# ---------- 模块级单例 ----------
+cache = LLMCache()
+
+
+def cached_chat(client, ttl: int = PLAN_TTL, on_usage: Optional[Callable[[Any], None]] = None,
+                **kwargs: Any) -> str:
+    """
+    带缓存的 client.chat.completions.create，返回 message.content。
+    :param client: OpenAI 客户端
+    :param ttl: 缓存有效期（秒）
+    :param on_usage: 未命中缓存、真正请求后以响应的 usage 回调（如统计 OpenAI 提示缓存命中），不参与缓存键
+    :param kwargs: 透传给 chat.completions.create 的参数
+    """
+    key = LLMCache.make_key(**kwargs)
+    hit = cache.get(key)
+    if hit is not None:
+        return hit
+    rsp = client.chat.completions.create(**kwargs)
+    if on_usage and rsp.usage:
+        on_usage(rsp.usage)
+    content = rsp.choices[0].message.content or ""
+    cache.set(key, content, ttl)
+    return content
+
+
+async def acached_chat(aclient, ttl: int = PLAN_TTL, on_usage: Optional[Callable[[Any], None]] = None,
+                       **kwargs: Any) -> str:
+    """异步版 cached_chat，aclient 为 AsyncOpenAI 客户端；与同步版共用缓存。"""
+    key = LLMCache.make_key(**kwargs)
+    hit = cache.get(key)
+    if hit is not None:
+        return hit
+    rsp = await aclient.chat.completions.create(**kwargs)
+    if on_usage and rsp.usage:
+        on_usage(rsp.usage)
+    content = rsp.choices[0].message.content or ""
+    cache.set(key, content, ttl)
+    return content
+
+
+def cached_chat_stream(client, on_delta: Callable[[str], None], ttl: int = ANSWER_TTL, **kwargs: Any) -> str:
+    """
+    流式版 cached_chat：每收到一段增量即回调 on_delta，结束后返回完整文本。
+    命中缓存时整段文本作为一次增量回调。
+    """
+    key = LLMCache.make_key(**kwargs)
+    hit = cache.get(key)
+    if hit is not None:
+        on_delta(hit)
+        return hit
+    parts: List[str] = []
+    for chunk in client.chat.completions.create(stream=True, **kwargs):
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content or ""
+        if delta:
+            parts.append(delta)
+            on_delta(delta)
+    content = "".join(parts)
+    cache.set(key, content, ttl)
+    return content
+
+
+async def acached_chat_stream(aclient, on_delta: Callable[[str], None], ttl: int = ANSWER_TTL, **kwargs: Any) -> str:
+    """异步版 cached_chat_stream，aclient 为 AsyncOpenAI 客户端；与同步版共用缓存。"""
+    key = LLMCache.make_key(**kwargs)
+    hit = cache.get(key)
+    if hit is not None:
+        on_delta(hit)
+        return hit
+    parts: List[str] = []
+    async for chunk in await aclient.chat.completions.create(stream=True, **kwargs):
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content or ""
+        if delta:
+            parts.append(delta)
+            on_delta(delta)
+    content = "".join(parts)
+    cache.set(key, content, ttl)
+    return content
+
+
+def cached_chat_lines(client, ttl: int = PLAN_TTL, **kwargs: Any) -> Iterator[str]:
+    """
+    流式版 cached_chat，按完整行产出模型输出，供规划边生成边解析。
+    命中缓存时直接回放；未命中时流式产出，完整读完后才写入缓存。
+    """
+    key = LLMCache.make_key(**kwargs)
+    hit = cache.get(key)
+    if hit is not None:
+        lines = hit.split("\n")
+        yield from lines if lines[-1] else lines[:-1]    # 与流式一致：不产出末尾空行
+        return
+    parts: List[str] = []
+    buf = ""
+    for chunk in client.chat.completions.create(stream=True, **kwargs):
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content or ""
+        parts.append(delta)
+        *lines, buf = (buf + delta).split("\n")
+        yield from lines
+    if buf:
+        yield buf
+    cache.set(key, "".join(parts), ttl)
+
+
+# ---------- 规划缓存（精确 + 语义） ----------
+class PlanCache:
+    """
+    规划结果缓存，持久化在 sqlite：
+    - sig：规划函数 + 除任务外的全部入参（页面列表等）的哈希，只在同一 sig 内复用；
+    - fp：sig + 任务原文的哈希，用于精确命中；
+    - emb：任务文本的 embedding（需 numpy），同一 sig 下余弦相似度 ≥ threshold 即命中。
+    条目数超过 maxsize 时淘汰命中次数最少的（LFU）；给出 ttl 时，写入超过 ttl 秒的条目不再命中。
+    agent 子任务结果缓存复用同一结构。
+    """
+
+    def __init__(self, path: str = PLAN_CACHE_PATH, maxsize: int = PLAN_CACHE_MAX,
+                 threshold: float = PLAN_SIM_THRESHOLD, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.threshold = threshold
+        self.ttl = ttl
+        self.path = path
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+
+    def _conn(self) -> sqlite3.Connection:
+        """首次读写时才打开 sqlite，import 本模块不会创建文件；调用方须持有 self._lock。"""
+        if self._db is None:
+            if self.path != ":memory:":
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            db = sqlite3.connect(self.path, check_same_thread=False)
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS plans ("
+                "fp TEXT PRIMARY KEY, sig TEXT, emb BLOB, plan TEXT, "
+                "hits INTEGER DEFAULT 0, used REAL, born REAL)"
+            )
+            try:                                   # 旧库没有 born 列
+                db.execute("ALTER TABLE plans ADD COLUMN born REAL")
+            except sqlite3.OperationalError:
+                pass
+            db.execute("CREATE INDEX IF NOT EXISTS plans_sig ON plans(sig)")
+            db.commit()
+            self._db = db
+        return self._db
+
+    def _oldest(self) -> float:
+        """仍然有效的最早写入时间；未设置 ttl 时不限。"""
+        return time.time() - self.ttl if self.ttl is not None else float("-inf")
+
+    def get_exact(self, fp: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn().execute(
+                "SELECT plan FROM plans WHERE fp=? AND IFNULL(born, 0) >= ?", (fp, self._oldest())
+            ).fetchone()
+            if row:
+                self._touch(fp)
+            return row[0] if row else None
+
+    def get_similar(self, sig: str, emb: "np.ndarray", threshold: Optional[float] = None) -> Optional[str]:
+        with self._lock:
+            rows = self._conn().execute(
+                "SELECT fp, emb, plan FROM plans WHERE sig=? AND emb IS NOT NULL AND IFNULL(born, 0) >= ?",
+                (sig, self._oldest()),
+            ).fetchall()
+            if not rows:
+                return None
+            mat = np.stack([np.frombuffer(r[1], dtype=np.float32) for r in rows])
+            sims = mat @ emb          # 入库前已归一化，点积即余弦
+            best = int(sims.argmax())
+            if sims[best] < (self.threshold if threshold is None else threshold):
+                return None
+            self._touch(rows[best][0])
+            return rows[best][2]
+
+    def put(self, fp: str, sig: str, emb: Optional["np.ndarray"], plan: str):
+        blob = emb.astype(np.float32).tobytes() if emb is not None else None
+        with self._lock:
+            db = self._conn()
+            db.execute(
+                "INSERT OR REPLACE INTO plans (fp, sig, emb, plan, hits, used, born) VALUES (?, ?, ?, ?, 0, ?, ?)",
+                (fp, sig, blob, plan, time.time(), time.time()),
+            )
+            if self.ttl is not None:
+                db.execute("DELETE FROM plans WHERE IFNULL(born, 0) < ?", (self._oldest(),))
+            excess = db.execute("SELECT COUNT(*) FROM plans").fetchone()[0] - self.maxsize
+            if excess > 0:
+                db.execute(
+                    "DELETE FROM plans WHERE fp IN "
+                    "(SELECT fp FROM plans ORDER BY hits ASC, used ASC LIMIT ?)", (excess,)
+                )
+            db.commit()
+
+    def _touch(self, fp: str):
+        db = self._conn()
+        db.execute("UPDATE plans SET hits=hits+1, used=? WHERE fp=?", (time.time(), fp))
+        db.commit()
+
+
+plan_cache = PlanCache()
+agent_cache = PlanCache(AGENT_CACHE_PATH, AGENT_CACHE_MAX, AGENT_SIM_THRESHOLD, AGENT_TTL)
+
+
+def _embed(client, text: str) -> Optional["np.ndarray"]:
+    if not NUMPY_AVAILABLE:
+        return None
+    try:
+        rsp = client.embeddings.create(model=EMBED_MODEL, input=text)
+    except Exception:
+        return None
+    vec = np.asarray(rsp.data[0].embedding, dtype=np.float32)
+    return vec / (np.linalg.norm(vec) or 1.0)
+
+
+def embed_many(client, texts: List[str]) -> Optional["np.ndarray"]:
+    """一次请求批量取 embedding，返回按行归一化的矩阵；numpy 不可用或请求失败时返回 None。"""
+    if not NUMPY_AVAILABLE or not texts:
+        return None
+    try:
+        rsp = client.embeddings.create(model=EMBED_MODEL, input=texts)
+    except Exception:
+        return None
+    mat = np.asarray([d.embedding for d in rsp.data], dtype=np.float32)
+    return mat / np.maximum(np.linalg.norm(mat, axis=1, keepdims=True), 1e-12)
+
+
+def cached_plan(client, threshold: Optional[float] = None):
+    """
+    规划方法装饰器：被装饰方法形如 fn(self, task, *rest, **kw)，返回可 JSON 序列化的规划结果。
+    默认只按 (fn, task, rest) 精确查找：子任务描述、相关页面挑选、是否拆分等结果依赖任务原文，
+    相近任务之间不能互相复用。只有结果与任务措辞无关的规划（把全部页面 / 文本块分给 agent）
+    才传 threshold，在同一 (fn, rest) 下按任务 embedding 做语义查找（余弦 ≥ threshold）。
+    都未命中才调用原方法，空结果不入缓存。
+    关键字参数（如本次调度的 AsyncOpenAI 客户端）不参与缓存键；协程方法同样适用，embedding 请求放到线程中执行。
+    """
+    def deco(fn):
+        name = f"{fn.__module__}.{fn.__qualname__}"
+
+        def lookup(task: str, rest: tuple, emb=None):
+            sig = LLMCache.make_key(fn=name, rest=rest)
+            fp = LLMCache.make_key(sig=sig, task=task)
+            hit = plan_cache.get_exact(fp) if emb is None else plan_cache.get_similar(sig, emb, threshold)
+            return sig, fp, hit
+
+        def store(sig: str, fp: str, emb, plan):
+            if plan or isinstance(plan, bool):
+                plan_cache.put(fp, sig, emb, json.dumps(plan, ensure_ascii=False))
+            return plan
+
+        if inspect.iscoroutinefunction(fn):
+            @wraps(fn)
+            async def awrapper(self, task: str, *rest, **kw):
+                sig, fp, hit = lookup(task, rest)
+                if hit is not None:
+                    return json.loads(hit)
+                emb = await asyncio.to_thread(_embed, client, task) if threshold is not None else None
+                if emb is not None and (hit := lookup(task, rest, emb)[2]) is not None:
+                    return json.loads(hit)
+                return store(sig, fp, emb, await fn(self, task, *rest, **kw))
+            return awrapper
+
+        @wraps(fn)
+        def wrapper(self, task: str, *rest, **kw):
+            sig, fp, hit = lookup(task, rest)
+            if hit is not None:
+                return json.loads(hit)
+            emb = _embed(client, task) if threshold is not None else None
+            if emb is not None and (hit := lookup(task, rest, emb)[2]) is not None:
+                return json.loads(hit)
+            return store(sig, fp, emb, fn(self, task, *rest, **kw))
+        return wrapper
+    return deco
+
+
+def cached_agent_call(client, url: str, task: str, content: str, memory: Any,
+                      call: Callable[[], Dict[str, Any]], semantic: bool = False) -> Dict[str, Any]:
+    """
+    agent 子任务响应缓存（有效期 AGENT_TTL）：按 端点 URL + 任务 + 子任务内容 + shared_memory 摘要 精确查找，
+    未命中才执行 call()。memory 为预序列化的 bytes 时直接取摘要，否则按排序后的 JSON 计算。
+    semantic=True 时（仅限 GPT 拆出的子任务描述，不可用于页面 / 文本内容），
+    在同一端点、同一任务、同一 memory 下再按内容 embedding 做语义查找（余弦 ≥ AGENT_SIM_THRESHOLD）；
+    否则不请求 embedding。没有 result 的响应不入缓存。
+    """
+    if not isinstance(memory, bytes):
+        memory = json.dumps(memory, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")
+    sig = LLMCache.make_key(url=url, task=task, memory=hashlib.blake2b(memory, digest_size=16).hexdigest())
+    fp = LLMCache.make_key(sig=sig, content=content)
+    hit = agent_cache.get_exact(fp)
+    if hit is not None:
+        return json.loads(hit)
+    emb = _embed(client, content) if semantic else None
+    if emb is not None:
+        hit = agent_cache.get_similar(sig, emb)
+        if hit is not None:
+            return json.loads(hit)
+    out = call()
+    if isinstance(out, dict) and out.get("result"):
+        agent_cache.put(fp, sig, emb, json.dumps(out, ensure_ascii=False))
+    return out
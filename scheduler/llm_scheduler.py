@@ -1,7 +1,8 @@
-import json, textwrap, requests, fitz, uuid                    # ← uuid 用来生成 subtask_id
+import json, textwrap, asyncio, httpx, uuid                         # ← uuid 用来生成 subtask_id
 from typing import List, Dict, Tuple, Any, Callable, Optional
 from openai import OpenAI
 from mcp.memory import MemoryStore
+from scheduler.llm_cache import cached_plan, PLAN_SIM_THRESHOLD
 import os
 
 client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
@@ -14,6 +15,21 @@ REGISTRY: Dict[str, Dict[str, str]] = {
     "web_build_agent": {"url": "http://http://54.179.24.46:5000/infer",
                        "desc": "可以用来构建网页，输入prompt给这个agent，返回一个URL。这个URL就是生成的网页的地址"}
 }
+# REGISTRY 静态，规划用的 system prompt 导入时拼好
+_REGISTRY_DESC="\n".join(f"{k}: {v['desc']}" for k,v in REGISTRY.items())
+_PLAN_PDF_SYS="根据 agent 能力分配页面，返回 JSON {agent:[page_id,…]}。\n"+_REGISTRY_DESC
+_PLAN_TEXT_SYS="判断任务是否需要拆分为多个子任务；需要则拆分并分配 agent。\n"+ \
+    "返回 JSON {\"need_split\":true/false,\"plan\":{agent:[子任务,…]}}，不拆分时 plan 为空。\n"+_REGISTRY_DESC
+
+AGENT_TIMEOUT=180
+AGENT_CONCURRENCY=8     # 单个 agent 端点同时在途的请求数
+AGENT_LIMITS=httpx.Limits(max_connections=64,max_keepalive_connections=32)
+AGENT_RETRIES=2         # 仅重试建连失败
+
+def _agent_client():
+    """一次 dispatch 内共用的连接池（keep-alive 复用 + 建连重试）"""
+    return httpx.AsyncClient(timeout=AGENT_TIMEOUT,
+        transport=httpx.AsyncHTTPTransport(limits=AGENT_LIMITS,retries=AGENT_RETRIES))
 
 def _page_ranges(ids: List[str]) -> List[Tuple[str, str]]:
     nums = sorted(int(i.split("_")[1]) for i in ids)
@@ -29,54 +45,81 @@ class LLMScheduler:
     @staticmethod
     def _push(cb,p): cb and cb(p)
     @staticmethod
-    def _pdf_pages(data): return [(f"page_{i+1}",p.get_text("text"))
-                                  for i,p in enumerate(fitz.open(stream=data,filetype="pdf"))]
+    def _pdf_pages(data):
+        import fitz                                     # 按需导入：纯文本调度不加载 PyMuPDF
+        if hasattr(data,"read"): data=data.read()       # 服务端传入的 SpooledTemporaryFile
+        return [(f"page_{i+1}",p.get_text("text"))
+                for i,p in enumerate(fitz.open(stream=data,filetype="pdf"))]
 
-    def _call_agent(self, ag: str, payload: Dict[str,Any]):
+    async def _call_agent(self, http, sem, ag: str, payload: Dict[str,Any]):
         """MCP：始终发送 JSON，其中至少包含 subtask_id 与 prompt"""
         try:
-            r = requests.post(REGISTRY[ag]["url"], json=payload, timeout=180)
+            async with sem:
+                r = await http.post(REGISTRY[ag]["url"], json=payload)
             res = r.json() if r.status_code == 200 else {}
             return ("succeed", res.get("result", "")) if "result" in res \
                    else ("failed", str(res)[:120])
         except Exception as e:
             return "failed", f"[❌]{e}"
 
+    async def _run_subtask(self, http, sem, st, prompt, progress_cb):
+        self._push(progress_cb,{"type":"subtask_start","data":st})
+        self._push(progress_cb,{"type":"action_start",
+                                "data":{"subtask_index":st["index"],
+                                        "index":1,
+                                        "agent_name":st["agent"],
+                                        "description":st["description"]}})
+
+        # 发送符合 MCP 的载荷：带 subtask_id
+        payload = {"subtask_id": st["subtask_id"], "prompt": prompt}
+        status,result=await self._call_agent(http, sem, st["agent"], payload)
+
+        self._push(progress_cb,{"type":"action_end",
+                                "data":{"subtask_index":st["index"],
+                                        "index":1,
+                                        "agent_name":st["agent"],
+                                        "status":status,
+                                        "result_format":"markdown",
+                                        "result":result}})
+        self._push(progress_cb,{"type":"subtask_end",
+                                "data":{"index":st["index"]}})
+
+    async def _run_subtasks(self, subtasks, prompts, progress_cb):
+        """全部子任务并发执行；每个 agent 端点一个 Semaphore 限流"""
+        sems={ag:asyncio.Semaphore(AGENT_CONCURRENCY) for ag in REGISTRY}
+        async with _agent_client() as http:
+            await asyncio.gather(*[self._run_subtask(http,sems[st["agent"]],st,pr,progress_cb)
+                                   for st,pr in zip(subtasks,prompts)])
+
     # ---------- GPT 规划 ----------（保持原样） ---------------------------
+    @cached_plan(client, PLAN_SIM_THRESHOLD)     # 只分配页面、不改写任务，相近任务可复用
     def _plan_pdf(self,task,pages):
         summary_lines=[]
         for pid,txt in pages:
             clean=txt.replace("\n"," ")
             summary_lines.append(f"{pid}: {textwrap.shorten(clean,120)}")
-        system="根据 agent 能力分配页面，返回 JSON {agent:[page_id,…]}。\n"+ \
-               "\n".join(f"{k}: {v['desc']}" for k,v in REGISTRY.items())
         rsp=client.chat.completions.create(
             model="gpt-4o",
-            messages=[{"role":"system","content":system},
+            messages=[{"role":"system","content":_PLAN_PDF_SYS},
                       {"role":"user","content":"任务:"+task+"\n页面:\n"+"\n".join(summary_lines)}],
             response_format={"type":"json_object"})
         try: data=json.loads(rsp.choices[0].message.content)
         except: data={}
         return {k:v for k,v in data.items() if k in REGISTRY and isinstance(v,list)}
 
-    def _need_split(self,task):
-        rsp=client.chat.completions.create(
-            model="gpt-4o",
-            messages=[{"role":"system","content":"仅回答 yes/no"},
-                      {"role":"user","content":task}],max_tokens=1)
-        return rsp.choices[0].message.content.strip().lower().startswith("y")
-
-    def _plan_text(self,task):
-        sys="拆分任务并分配 agent，返回 JSON {agent:[子任务,…]}。\n"+ \
-            "\n".join(f"{k}: {v['desc']}" for k,v in REGISTRY.items())
+    @cached_plan(client)
+    def _plan_text_combined(self,task):
+        """一次调用同时判断是否拆分并给出分配：{"need_split":bool,"plan":{agent:[子任务,…]}}"""
         rsp=client.chat.completions.create(
             model="gpt-4o",
-            messages=[{"role":"system","content":sys},
+            messages=[{"role":"system","content":_PLAN_TEXT_SYS},
                       {"role":"user","content":task}],
             response_format={"type":"json_object"})
         try: data=json.loads(rsp.choices[0].message.content)
-        except: data={}
-        return {k:v for k,v in data.items() if k in REGISTRY and isinstance(v,list)}
+        except: return {}
+        plan=data.get("plan") if isinstance(data.get("plan"),dict) else {}
+        return {"need_split":str(data.get("need_split")).lower() in ("true","yes"),
+                "plan":{k:v for k,v in plan.items() if k in REGISTRY and isinstance(v,list)}}
 
     # ---------- dispatch ---------- ---------------------------------------
     def dispatch(self,ctx,task,*,pdf_bytes=None,
@@ -85,11 +128,11 @@ class LLMScheduler:
         self._push(progress_cb,{"type":"chat_text",
                                 "data":{"message":"已接收任务，开始规划…"}})
 
-        subtasks=[]; page_dict={}
+        subtasks=[]; page_texts=[]
 
         # ---- PDF ----
         if pdf_bytes:
-            pages=self._pdf_pages(pdf_bytes); page_dict=dict(pages)
+            pages=self._pdf_pages(pdf_bytes); page_texts=[t for _,t in pages]   # page_N ↔ page_texts[N-1]
             plan=self._plan_pdf(task,pages) or {}
             if not plan:
                 half=len(pages)//2 or 1
@@ -108,7 +151,9 @@ class LLMScheduler:
                     idx+=1
         # ---- TEXT ----
         else:
-            if not self._need_split(task):
+            res=self._plan_text_combined(task)
+            plan=res.get("plan") if res.get("need_split") else None
+            if not plan:
                 subtasks=[{
                     "index": 1,
                     "subtask_id": uuid.uuid4().hex,
@@ -116,7 +161,7 @@ class LLMScheduler:
                     "agent": next(iter(REGISTRY))
                 }]
             else:
-                plan=self._plan_text(task); idx=1
+                idx=1
                 for ag,lst in plan.items():
                     for s in lst:
                         subtasks.append({
@@ -131,37 +176,17 @@ class LLMScheduler:
                                                  "description":s["description"]}
                                                  for s in subtasks]}})
 
-        # ---- execute subtasks ----
+        # ---- execute subtasks（并发） ----
+        prompts=[]
         for st in subtasks:
-            self._push(progress_cb,{"type":"subtask_start","data":st})
-            self._push(progress_cb,{"type":"action_start",
-                                    "data":{"subtask_index":st["index"],
-                                            "index":1,
-                                            "agent_name":st["agent"],
-                                            "description":st["description"]}})
-
             if pdf_bytes:
                 p1,p2=st["pages"]
-                s=int(p1.split("_")[1]); e=int(p2.split("_")[1])
-                prompt="【任务】"+task+"\n\n" + "\n\n".join(
-                    page_dict[f"page_{i}"] for i in range(s,e+1))
+                s=int(p1.split("_",1)[1]); e=int(p2.split("_",1)[1])
+                prompts.append("【任务】"+task+"\n\n" + "\n\n".join(page_texts[s-1:e]))
             else:
-                prompt="【任务】"+task+"\n\n【子任务】"+st["description"]
-
-            # 发送符合 MCP 的载荷：带 subtask_id
-            payload = {"subtask_id": st["subtask_id"], "prompt": prompt}
-
-            status,result=self._call_agent(st["agent"], payload)
-
-            self._push(progress_cb,{"type":"action_end",
-                                    "data":{"subtask_index":st["index"],
-                                            "index":1,
-                                            "agent_name":st["agent"],
-                                            "status":status,
-                                            "result_format":"markdown",
-                                            "result":result}})
-            self._push(progress_cb,{"type":"subtask_end",
-                                    "data":{"index":st["index"]}})
+                prompts.append("【任务】"+task+"\n\n【子任务】"+st["description"])
+        if subtasks:
+            asyncio.run(self._run_subtasks(subtasks,prompts,progress_cb))
 
         self._push(progress_cb,{"type":"chat_file",
                                 "data":{"format":"markdown",
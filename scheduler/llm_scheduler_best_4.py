@@ -1,18 +1,21 @@
 import os
 import io
-import requests
-from typing import List, Tuple, Dict, Optional
+import re
+import hashlib
+import asyncio
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from collections import defaultdict
+from functools import lru_cache
+from typing import List, Tuple, Dict, Optional, Any, Callable, Iterator
+
+import httpx
+import orjson
 
 import fitz  # PyMuPDF – 精准提取文本
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 from mcp.memory import MemoryStore
-
-try:
-    from pdf2image import convert_from_bytes
-    import pytesseract
-    OCR_AVAILABLE = True
-except ImportError:
-    OCR_AVAILABLE = False
+from scheduler.page_stream import PageStream
+from scheduler.llm_cache import cached_plan, cached_chat, acached_chat, ANSWER_TTL, PLAN_SIM_THRESHOLD
 
 # ---------------- 全局配置 ----------------
 client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
@@ -21,6 +24,99 @@ REGISTRY: Dict[str, str] = {
     "llama2_agent":   "http://136.59.129.136:34517/infer",
     "llama2_agent_2": "http://142.214.185.187:30934/infer"
 }
+REGISTRY_KEYS = frozenset(REGISTRY)
+
+# ---------- 规划 system prompt（REGISTRY 静态，导入时拼好） ----------
+_AGENT_LIST = ", ".join(REGISTRY)
+_PLAN_SYS = (
+    "你是任务调度专家，请根据【任务】分配页面给以下 agent："
+    + _AGENT_LIST + "。只返回分配结果，每行格式：agent: id1,id2 或 agent: m-n。"
+)
+
+AGENT_TIMEOUT = 120
+AGENT_CONCURRENCY = 8    # 单个 agent 端点同时在途的请求数
+AGENT_LIMITS = httpx.Limits(max_connections=64, max_keepalive_connections=32)
+AGENT_RETRIES = 2        # 仅重试建连失败
+AGENT_HEADERS = {"Content-Type": "application/json"}   # 载荷由 orjson 预先序列化
+SHARED_MEMORY_REFS = os.getenv("SHARED_MEMORY_REFS") == "1"   # agent 端能按 shared_memory_ref 取回快照时开启
+SUMMARY_CONCURRENCY = 8  # 每页摘要同时在途的 GPT‑4o 请求数
+
+
+def _memory_digest(snapshot: Dict[str, Any]) -> str:
+    raw = orjson.dumps(snapshot, default=str, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS)
+    return hashlib.sha256(raw).hexdigest()
+
+
+def _dump_payload(payload: Dict[str, Any]) -> bytes:
+    """
+    序列化 agent 载荷。shared_memory 为 bytes 时视为调度开始时预序列化的快照，
+    直接拼到 JSON 对象末尾，同一快照每次 dispatch 只序列化一次。
+    """
+    mem = payload.get("shared_memory")
+    if not isinstance(mem, bytes):
+        return orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS)
+    body = orjson.dumps({k: v for k, v in payload.items() if k != "shared_memory"},
+                        option=orjson.OPT_NON_STR_KEYS)
+    return (body[:-1] + b"," if len(body) > 2 else b"{") + b'"shared_memory":' + mem + b"}"
+
+
+def _agent_client() -> httpx.AsyncClient:
+    """一次 dispatch 内所有 agent 调用共用的连接池（keep-alive 复用）。"""
+    transport = httpx.AsyncHTTPTransport(limits=AGENT_LIMITS, retries=AGENT_RETRIES)
+    return httpx.AsyncClient(transport=transport, timeout=AGENT_TIMEOUT, headers=AGENT_HEADERS)
+
+
+# ---------- OCR 备份方案（可选，按需导入） ----------
+@lru_cache(maxsize=1)
+def _ocr_backend():
+    """首次遇到无文本层页面时才导入 pdf2image / pytesseract；缺依赖时返回 None。"""
+    try:
+        from pdf2image import convert_from_bytes
+        import pytesseract
+    except ImportError:
+        return None
+    return convert_from_bytes, pytesseract
+
+
+def _ocr_page(pdf_bytes: bytes, idx: int) -> str:
+    """单页 OCR（顶层函数，供 ProcessPoolExecutor pickle）。"""
+    convert_from_bytes, pytesseract = _ocr_backend()
+    img = convert_from_bytes(pdf_bytes, dpi=300, first_page=idx, last_page=idx)[0]
+    return pytesseract.image_to_string(img, lang="eng+chi_sim")
+
+
+# ---------- 规划解析 ----------
+_NUM_RE = re.compile(r"\d+")
+_ALPHA_RE = re.compile(r"[A-Za-z_]+")
+
+
+# ---------- 页面区间合并 ----------
+MAX_RANGE_PAGES = 4      # 单次请求最多合并的连续页数（受 agent 上下文长度限制）
+_PAGE_MARK_RE = re.compile(r"^#{2,3}\s*(page_\d+)\s*$", re.M)
+
+
+def _page_ranges(pids: List[str]) -> List[List[str]]:
+    """把页号连续的 page_id 合并为一组（每组至多 MAX_RANGE_PAGES 页），每组只发一次请求。"""
+    runs: List[List[str]] = []
+    prev = None
+    for n in sorted({int(p.split("_")[1]) for p in pids}):
+        if runs and n == prev + 1 and len(runs[-1]) < MAX_RANGE_PAGES:
+            runs[-1].append(f"page_{n}")
+        else:
+            runs.append([f"page_{n}"])
+        prev = n
+    return runs
+
+
+def _run_label(run: List[str]) -> str:
+    return run[0] if len(run) == 1 else f"{run[0]}-{run[-1]}"
+
+
+def _split_by_page(text: str, run: List[str]) -> Dict[str, str]:
+    """按 agent 输出中的 `### page_N` 标记拆回各页；没有标记时整段归到首页。"""
+    parts = _PAGE_MARK_RE.split(text)
+    out = {pid: body.strip() for pid, body in zip(parts[1::2], parts[2::2]) if pid in run}
+    return out or {run[0]: text.strip()}
 
 # =============================================================
 class LLMScheduler:
@@ -32,54 +128,143 @@ class LLMScheduler:
 
     # ---------- PDF → 逐页文本 ----------
     @staticmethod
-    def _pdf_pages(pdf_bytes: bytes) -> List[Tuple[str, str]]:
-        pages: List[Tuple[str, str]] = []
+    def _pdf_page_ids(pdf_bytes: bytes) -> List[str]:
+        with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+            return [f"page_{idx}" for idx in range(1, doc.page_count + 1)]
+
+    @staticmethod
+    def _iter_pdf_pages(pdf_bytes: bytes) -> Iterator[Tuple[str, str]]:
+        """逐页产出 (page_id, text)，不保证页序：有文本层的页面立即产出，其余交给 OCR 进程池，识别完即产出。"""
         doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-        for idx, page in enumerate(doc, 1):
-            txt = page.get_text("text") or ""
-            if not txt.strip() and OCR_AVAILABLE:
-                img = convert_from_bytes(pdf_bytes, dpi=300, first_page=idx, last_page=idx)[0]
-                txt = pytesseract.image_to_string(img, lang="eng+chi_sim")
-            pages.append((f"page_{idx}", txt.strip()))
-        return pages
+        ex: Optional[ProcessPoolExecutor] = None
+        futs = {}
+        try:
+            for idx, page in enumerate(doc, 1):
+                txt = page.get_text("text") or ""
+                if txt.strip() or _ocr_backend() is None:
+                    yield f"page_{idx}", txt.strip()
+                    continue
+                if ex is None:
+                    ex = ProcessPoolExecutor(max_workers=os.cpu_count() or 1)
+                futs[ex.submit(_ocr_page, pdf_bytes, idx)] = idx
+            for fut in as_completed(futs):
+                yield f"page_{futs[fut]}", fut.result().strip()
+        finally:
+            if ex is not None:
+                ex.shutdown(wait=False, cancel_futures=True)
 
     # ---------- GPT‑4o 规划 ----------
+    @cached_plan(client, PLAN_SIM_THRESHOLD)     # 只分配页面、不挑选，相近任务可复用
     def _plan(self, task: str, page_ids: List[str]) -> Dict[str, List[str]]:
         ids_str = ", ".join(page_ids) if page_ids else "(空)"
-        sys_msg = (
-            "你是任务调度专家，请根据【任务】分配页面给以下 agent："
-            + ", ".join(REGISTRY.keys()) + "。只返回分配结果，每行格式：agent: id1,id2 或 agent: m-n。"
-        )
         user_msg = f"【任务】{task}\n【页面列表】{ids_str}"
         rsp = client.chat.completions.create(
             model="gpt-4o",
-            messages=[{"role": "system", "content": sys_msg}, {"role": "user", "content": user_msg}]
+            messages=[{"role": "system", "content": _PLAN_SYS}, {"role": "user", "content": user_msg}]
         )
         return self._parse_plan(rsp.choices[0].message.content)
 
     @staticmethod
     def _parse_plan(text: str) -> Dict[str, List[str]]:
-        plan = {k: [] for k in REGISTRY}
+        plan: Dict[str, List[str]] = defaultdict(list)   # 只为实际出现的 agent 建列表
         for line in text.splitlines():
             if ':' not in line:
                 continue
             ag, ids = line.split(':', 1)
             ag = ag.strip()
-            if ag not in REGISTRY:
+            if ag not in REGISTRY_KEYS:
                 continue
             ids = ids.replace(' ', '')
             for part in ids.split(','):
                 if not part:
                     continue
                 if '-' in part:
-                    start, end = part.split('-')
-                    s_idx = int(''.join(filter(str.isdigit, start)))
-                    e_idx = int(''.join(filter(str.isdigit, end)))
-                    prefix = ''.join(filter(str.isalpha, start)) or 'page_'
-                    plan[ag] += [f"{prefix}{i}" for i in range(s_idx, e_idx + 1)]
+                    start, end = part.split('-', 1)
+                    s_m, e_m = _NUM_RE.search(start), _NUM_RE.search(end)
+                    if not (s_m and e_m):
+                        continue
+                    s_idx, e_idx = int(s_m.group()), int(e_m.group())
+                    p_m = _ALPHA_RE.match(start)
+                    prefix = p_m.group() if p_m else 'page_'
+                    if s_idx <= e_idx:
+                        plan[ag].extend(f"{prefix}{i}" for i in range(s_idx, e_idx + 1))
                 else:
                     plan[ag].append(part)
-        return {k: v for k, v in plan.items() if v}
+        return dict(plan)
+
+    # ---------- 并发调用 Agent ----------
+    async def _call_agent(self, http: httpx.AsyncClient, sem: asyncio.Semaphore,
+                          ag: str, payload: Dict[str, Any],
+                          uploads: Dict[str, "asyncio.Future[bool]"]) -> Dict[str, Any]:
+        """
+        带 shared_memory_id 的载荷按 agent 去重：首个请求携带快照正文，
+        其余请求等它成功后只发 shared_memory_ref；首个请求失败则照常携带正文。
+        """
+        first = None
+        mem_id = payload.get("shared_memory_id")
+        if mem_id:
+            if ag not in uploads:
+                first = uploads[ag] = asyncio.get_running_loop().create_future()
+            elif await uploads[ag]:
+                payload = {k: v for k, v in payload.items() if k not in ("shared_memory", "shared_memory_id")}
+                payload["shared_memory_ref"] = mem_id
+        ok = False
+        try:
+            async with sem:
+                resp = await http.post(REGISTRY[ag], content=_dump_payload(payload))
+                out = orjson.loads(resp.content)
+                ok = resp.status_code == 200
+                return out
+        finally:
+            if first is not None:
+                first.set_result(ok)
+
+    async def _stream_calls(self, stream: PageStream, runs: List[Tuple[str, List[str]]],
+                            make_payload: Callable[[str, List[str], Dict[str, str]], Dict[str, Any]]) -> List[Any]:
+        """
+        边解析边分发：某组页面全部解析完即发出该组请求，每个端点一个 Semaphore；
+        计划内的页面都到齐后不再等待其余页面。返回与 runs 一一对应的结果，异常作为结果返回。
+        """
+        loop = asyncio.get_running_loop()
+        sems = {ag: asyncio.Semaphore(AGENT_CONCURRENCY) for ag in REGISTRY}
+        page_map: Dict[str, str] = {}
+        waiting: Dict[str, List[int]] = {}
+        for i, (_, run) in enumerate(runs):
+            for pid in run:
+                waiting.setdefault(pid, []).append(i)
+        remaining = [len(run) for _, run in runs]
+        tasks = []
+        uploads: Dict[str, "asyncio.Future[bool]"] = {}
+        async with _agent_client() as http:
+            while len(tasks) < len(runs) and (page := await loop.run_in_executor(None, stream.get)):
+                pid, txt = page
+                page_map[pid] = txt
+                for i in waiting.get(pid, ()):
+                    remaining[i] -= 1
+                    if not remaining[i]:
+                        ag, run = runs[i]
+                        tasks.append((i, asyncio.create_task(
+                            self._call_agent(http, sems[ag], ag, make_payload(ag, run, page_map), uploads)
+                        )))
+            done = await asyncio.gather(*[t for _, t in tasks], return_exceptions=True)
+        results: List[Any] = [RuntimeError("页面未解析")] * len(runs)
+        for (i, _), res in zip(tasks, done):
+            results[i] = res
+        return results
+
+    async def _summarize_pages(self, to_summarize: List[Tuple[str, str]]) -> Dict[str, str]:
+        """所有页面摘要并发请求；AsyncOpenAI 绑定事件循环，因此每次调度单独创建。"""
+        sem = asyncio.Semaphore(SUMMARY_CONCURRENCY)
+        async with AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY")) as aclient:
+            async def summarize(pid: str, page_analysis: str) -> Tuple[str, str]:
+                async with sem:
+                    out = await acached_chat(
+                        aclient, ANSWER_TTL, model="gpt-4o",
+                        messages=[{"role": "user", "content": f"请总结：\n{page_analysis}"}]
+                    )
+                return pid, out.strip()
+
+            return dict(await asyncio.gather(*[summarize(pid, txt) for pid, txt in to_summarize]))
 
     # ---------- 主入口 ----------
     def dispatch(
@@ -94,60 +279,86 @@ class LLMScheduler:
         if not pdf_data:
             raise ValueError("dispatch 需要提供 pdf_bytes 或 file_bytes")
 
-        pages = self._pdf_pages(pdf_data)
-        page_map = dict(pages)
-        plan = self._plan(task, [pid for pid, _ in pages])
+        page_ids = self._pdf_page_ids(pdf_data)
+        # 规划只需要页面 ID：解析线程先行启动，与 GPT 规划、agent 请求重叠
+        stream = PageStream(self._iter_pdf_pages(pdf_data))
+        try:
+            plan = self._plan(task, page_ids)
 
-        # —— 分发到本地 Agent ——
-        for ag, pid_list in plan.items():
+            # —— 并发分发到本地 Agent（连续页面合并为一次请求，页面解析完即发出） ——
+            id_set = set(page_ids)
+            runs = [(ag, run) for ag, pid_list in plan.items()
+                    for run in _page_ranges([pid for pid in pid_list if pid in id_set])]
             snapshot = self.memory.get(context_id)
-            for pid in pid_list:
-                context_txt = page_map.get(pid, '')
-                prompt_text = f"【任务指令】{task}\n\n【{pid} 原文】\n{context_txt}"
+            mem_id = _memory_digest(snapshot) if SHARED_MEMORY_REFS and snapshot else None
+            snap_bytes = orjson.dumps(snapshot, option=orjson.OPT_NON_STR_KEYS)   # 所有请求共用
+
+            def make_payload(ag: str, run: List[str], page_map: Dict[str, str]) -> Dict[str, Any]:
+                mark = "" if len(run) == 1 else "\n\n请逐页作答，每页回答以单独一行 `### page_N` 开头。"
+                prompt_text = f"【任务指令】{task}{mark}\n\n" + "\n\n".join(
+                    f"【{pid} 原文】\n{page_map[pid]}" for pid in run
+                )
                 payload = {
                     "prompt": prompt_text,
                     "context_id": context_id,
-                    "page_id": pid,
+                    "page_id": _run_label(run),
                     "agent_name": ag,
-                    "shared_memory": snapshot
+                    "shared_memory": snap_bytes
                 }
-                try:
-                    resp = requests.post(REGISTRY[ag], json=payload, timeout=120)
-                    data = resp.json()
-                    mem_update = data.get('memory_update') or {ag: {pid: data.get('result', '')}}
-                except Exception as e:
-                    self.trace.append({"agent": ag, "subtask": pid, "output": f"[❌ 调用失败] {e}"})
-                    continue
+                if mem_id:
+                    payload["shared_memory_id"] = mem_id
+                return payload
+
+            results = asyncio.run(self._stream_calls(stream, runs, make_payload)) if runs else []
+        finally:
+            stream.close()
 
-                # 更新 memory
-                current = self.memory.get(context_id).get(ag, {})
-                if not isinstance(current, dict):
-                    current = {}
-                current.update(mem_update.get(ag, {}))
-                self.memory.update(context_id, {ag: current})
+        stored = self.memory.get(context_id)
+        agent_mems: Dict[str, Dict[str, str]] = {}
+        for (ag, run), data in zip(runs, results):
+            try:
+                if isinstance(data, BaseException):
+                    raise data
+                mem_update = data.get('memory_update') or {ag: _split_by_page(data.get('result', ''), run)}
+            except Exception as e:
+                self.trace.append({"agent": ag, "subtask": _run_label(run), "output": f"[❌ 调用失败] {e}"})
+                continue
+
+            # 按计划顺序合并到本地 dict（仍按页存储），循环结束后一次写回 memory
+            current = agent_mems.get(ag)
+            if current is None:
+                prev = stored.get(ag, {})
+                current = agent_mems[ag] = dict(prev) if isinstance(prev, dict) else {}
+            current.update(mem_update.get(ag, {}))
+            for pid in run:
                 self.trace.append({"agent": ag, "subtask": pid, "output": current.get(pid, '')})
 
-        # —— GPT‑4o 每页摘要 ——
-        page_summaries: Dict[str, str] = {}
-        for pid, _ in pages:
+        if agent_mems:
+            self.memory.update(context_id, agent_mems)
+        mem_snapshot = self.memory.get(context_id)    # 写回后取一次，汇总阶段复用
+
+        # —— GPT‑4o 每页摘要（并发） ——
+        to_summarize: List[Tuple[str, str]] = []
+        for pid in page_ids:
             page_analysis = ''
             for ag in plan:
-                ag_mem = self.memory.get(context_id).get(ag, {})
+                ag_mem = mem_snapshot.get(ag, {})
                 if pid in ag_mem:
                     page_analysis = ag_mem[pid]
                     break
-            if not page_analysis:
-                continue
-            rsp = client.chat.completions.create(model="gpt-4o", messages=[{"role": "user", "content": f"请总结：\n{page_analysis}"}])
-            page_summaries[pid] = rsp.choices[0].message.content.strip()
+            if page_analysis:
+                to_summarize.append((pid, page_analysis))
+        page_summaries = asyncio.run(self._summarize_pages(to_summarize)) if to_summarize else {}
         self.memory.update(context_id, {"page_summaries": page_summaries})
 
         # —— GPT‑4o 全文总结 ——
         overall_prompt = "下面是 PDF 每页摘要，请生成整体总结（共识/差异/建议）：\n\n"
         for pid in sorted(page_summaries, key=lambda x: int(x.split('_')[1])):
             overall_prompt += f"【{pid} 摘要】{page_summaries[pid]}\n"
-        rsp = client.chat.completions.create(model="gpt-4o", messages=[{"role": "user", "content": overall_prompt}])
-        final_summary = rsp.choices[0].message.content.strip()
+        final_summary = cached_chat(
+            client, ANSWER_TTL, model="gpt-4o",
+            messages=[{"role": "user", "content": overall_prompt}]
+        ).strip()
 
         self.memory.update(context_id, {"summary": final_summary})
         self.trace.append({"agent": "scheduler", "subtask": "自动生成全文总结", "output": final_summary})
@@ -1,12 +1,17 @@
 import os
-import io
-import requests
-from typing import List, Tuple, Dict
+import re
+import asyncio
+from collections import defaultdict
+from typing import List, Tuple, Dict, Any
 
-import PyPDF2
+import httpx
+import orjson
+
+import fitz  # PyMuPDF
 from openai import OpenAI
 
 from mcp.memory import MemoryStore
+from scheduler.llm_cache import cached_plan, cached_chat, ANSWER_TTL
 
 # ==================== 配置 ====================
 client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
@@ -15,14 +20,53 @@ REGISTRY: Dict[str, str] = {
     "llama2_agent": "http://136.59.129.136:34517/infer",
     "llama2_agent_2": "http://142.214.185.187:30934/infer"
 }
+REGISTRY_KEYS = frozenset(REGISTRY)
+
+# ---------- 规划 system prompt（REGISTRY 静态，导入时拼好） ----------
+_AGENT_LIST = ", ".join(REGISTRY)
+_PLAN_SYS = (
+    "你是任务调度专家。\n"
+    "给定完整的用户任务文本，以及文件材料的若干 group ID 列表（不含正文）。\n"
+    "若材料为空，则只基于用户任务；否则请判断材料是否需要处理，并将需要处理的 group 分配给下列 agent：\n"
+    + _AGENT_LIST + "\n"
+    "输出格式：agent_name: id1,id2 或 agent_name: start-end。除分配结果外不要解释。"
+)
 
 CHUNK_SIZE = 1200  # 约 ~400 token
 
+_NUM_RE = re.compile(r"\d+")
+_ALPHA_RE = re.compile(r"[A-Za-z_]+")
+
+AGENT_TIMEOUT = 60
+AGENT_CONCURRENCY = 8    # 单个 agent 端点同时在途的请求数
+AGENT_LIMITS = httpx.Limits(max_connections=64, max_keepalive_connections=32)
+AGENT_RETRIES = 2        # 仅重试建连失败
+AGENT_HEADERS = {"Content-Type": "application/json"}   # 载荷由 orjson 预先序列化
+
+
+def _dump_payload(payload: Dict[str, Any]) -> bytes:
+    """
+    序列化 agent 载荷。shared_memory 为 bytes 时视为调度开始时预序列化的快照，
+    直接拼到 JSON 对象末尾，同一快照每次 dispatch 只序列化一次。
+    """
+    mem = payload.get("shared_memory")
+    if not isinstance(mem, bytes):
+        return orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS)
+    body = orjson.dumps({k: v for k, v in payload.items() if k != "shared_memory"},
+                        option=orjson.OPT_NON_STR_KEYS)
+    return (body[:-1] + b"," if len(body) > 2 else b"{") + b'"shared_memory":' + mem + b"}"
+
+
+def _agent_client() -> httpx.AsyncClient:
+    """一次 dispatch 内所有 agent 调用共用的连接池（keep-alive 复用）。"""
+    transport = httpx.AsyncHTTPTransport(limits=AGENT_LIMITS, retries=AGENT_RETRIES)
+    return httpx.AsyncClient(transport=transport, timeout=AGENT_TIMEOUT, headers=AGENT_HEADERS)
+
 # ==================== Scheduler ====================
 class LLMScheduler:
     """调度流程：
     1. 接收用户任务文本 + 可选 PDF
-    2. PDF → 纯文本 → 切分为 group_n 片段
+    2. PDF → 纯文本（PyMuPDF）→ 切分为 group_n 片段
     3. 把『完整任务文本』+『group ID 列表』交 GPT‑4o，让其判断并生成分配方案
     4. 根据方案把 (instruction+context) 合并为 prompt，发送到本地 /infer
     5. 汇总结果并再请 GPT‑4o 生成总结
@@ -35,66 +79,82 @@ class LLMScheduler:
     # ---------- 工具 ----------
     @staticmethod
     def _pdf_to_text(pdf_bytes: bytes) -> str:
-        reader = PyPDF2.PdfReader(io.BytesIO(pdf_bytes))
-        return "\n\n".join(p.extract_text() or "" for p in reader.pages)
+        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+        return "\n\n".join(p.get_text("text") for p in doc)
 
     @staticmethod
     def _split_text(text: str) -> List[Tuple[str, str]]:
-        chunks, idx, buf = [], 1, []
+        # buf_len 始终等于 len("\n".join(buf))，避免每行重新拼接（O(n²) → O(n)）
+        chunks, idx, buf, buf_len = [], 1, [], 0
         for para in text.splitlines():
-            if len("\n".join(buf) + para) > CHUNK_SIZE:
+            if buf_len + len(para) > CHUNK_SIZE:
                 chunks.append((f"group_{idx}", "\n".join(buf).strip()))
                 idx += 1
-                buf = [para]
+                buf, buf_len = [para], len(para)
             else:
+                buf_len += len(para) + (1 if buf else 0)
                 buf.append(para)
         if buf:
             chunks.append((f"group_{idx}", "\n".join(buf).strip()))
         return chunks
 
     # ---------- 让 GPT‑4o 做任务判断 + 分配 ----------
+    @cached_plan(client)
     def _plan_with_gpt(self, user_text: str, groups: List[Tuple[str, str]]) -> Dict[str, List[str]]:
         group_ids = ", ".join(cid for cid, _ in groups) if groups else "(无)"
-        sys_prompt = (
-            "你是任务调度专家。\n"
-            "给定完整的用户任务文本，以及文件材料的若干 group ID 列表（不含正文）。\n"
-            "若材料为空，则只基于用户任务；否则请判断材料是否需要处理，并将需要处理的 group 分配给下列 agent：\n"
-            + ", ".join(REGISTRY.keys()) + "\n"
-            "输出格式：agent_name: id1,id2 或 agent_name: start-end。除分配结果外不要解释。"
-        )
         user_prompt = (
             f"【用户任务全文】\n{user_text}\n\n"
             f"【文件材料 group ID 列表】{group_ids}"
         )
         res = client.chat.completions.create(
             model="gpt-4o",
-            messages=[{"role": "system", "content": sys_prompt}, {"role": "user", "content": user_prompt}]
+            messages=[{"role": "system", "content": _PLAN_SYS}, {"role": "user", "content": user_prompt}]
         )
         return self._parse_plan(res.choices[0].message.content)
 
     @staticmethod
     def _parse_plan(text: str) -> Dict[str, List[str]]:
-        plan = {k: [] for k in REGISTRY}
+        plan: Dict[str, List[str]] = defaultdict(list)   # 只为实际出现的 agent 建列表
         for line in text.splitlines():
             if ":" not in line:
                 continue
             agent, ids = line.split(":", 1)
             agent = agent.strip()
-            if agent not in REGISTRY:
+            if agent not in REGISTRY_KEYS:
                 continue
             ids = ids.replace(" ", "")
             for part in ids.split(','):
                 if not part:
                     continue
                 if '-' in part:
-                    start, end = part.split('-')
-                    prefix = ''.join(filter(str.isalpha, start)) or 'group_'
-                    s = int(''.join(filter(str.isdigit, start)))
-                    e = int(''.join(filter(str.isdigit, end)))
-                    plan[agent] += [f"{prefix}{i}" for i in range(s, e + 1)]
+                    start, end = part.split('-', 1)
+                    s_m, e_m = _NUM_RE.search(start), _NUM_RE.search(end)
+                    if not (s_m and e_m):
+                        continue
+                    p_m = _ALPHA_RE.match(start)
+                    prefix = p_m.group() if p_m else 'group_'
+                    s, e = int(s_m.group()), int(e_m.group())
+                    if s <= e:
+                        plan[agent].extend(f"{prefix}{i}" for i in range(s, e + 1))
                 else:
                     plan[agent].append(part)
-        return {k: v for k, v in plan.items() if v}
+        return dict(plan)
+
+    # ---------- 并发调用 /infer ----------
+    async def _call_agent(self, http: httpx.AsyncClient, sem: asyncio.Semaphore,
+                          agent: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        async with sem:
+            resp = await http.post(REGISTRY[agent], content=_dump_payload(payload))
+            return orjson.loads(resp.content)
+
+    async def _call_agents(self, calls: List[Tuple[str, Dict[str, Any]]]) -> List[Any]:
+        """并发发送全部 (agent, payload)；每个端点一个 Semaphore，异常作为结果返回。"""
+        sems = {ag: asyncio.Semaphore(AGENT_CONCURRENCY) for ag in REGISTRY}
+        async with _agent_client() as http:
+            return await asyncio.gather(
+                *[self._call_agent(http, sems[ag], ag, payload) for ag, payload in calls],
+                return_exceptions=True
+            )
 
     # ---------- 主入口 ----------
     def dispatch(self, context_id: str, text: str, file_bytes: bytes | None = None):
@@ -106,8 +166,9 @@ class LLMScheduler:
         plan = self._plan_with_gpt(text, groups)
         id2text = dict(groups)
 
+        snap = orjson.dumps(self.memory.get(context_id), option=orjson.OPT_NON_STR_KEYS)   # 预序列化，所有请求共用
+        calls: List[Tuple[str, str, Dict[str, Any]]] = []
         for agent, gid_list in plan.items():
-            snap = self.memory.get(context_id)
             for gid in gid_list:
                 context_text = id2text.get(gid, "")
                 prompt = f"{text}\n\n{context_text}".strip()
@@ -117,23 +178,28 @@ class LLMScheduler:
                     "chunk_id": gid,
                     "shared_memory": snap
                 }
-                try:
-                    resp = requests.post(REGISTRY[agent], json=payload, timeout=60)
-                    out = resp.json()
-                    mem = out.get("memory_update") or {agent: out.get("result", "")}
-                except Exception as e:
-                    self.trace.append({"agent": agent, "subtask": gid, "output": f"[❌ 调用失败] {e}"})
-                    continue
+                calls.append((agent, gid, payload))
+        results = asyncio.run(self._call_agents([(ag, p) for ag, _, p in calls])) if calls else []
+
+        # 结果按计划顺序串行写回 memory
+        for (agent, gid, _), out in zip(calls, results):
+            try:
+                if isinstance(out, BaseException):
+                    raise out
+                mem = out.get("memory_update") or {agent: out.get("result", "")}
+            except Exception as e:
+                self.trace.append({"agent": agent, "subtask": gid, "output": f"[❌ 调用失败] {e}"})
+                continue
 
-                self.memory.update(context_id, mem)
-                self.trace.append({"agent": agent, "subtask": gid, "output": mem.get(agent, "")})
+            self.memory.update(context_id, mem)
+            self.trace.append({"agent": agent, "subtask": gid, "output": mem.get(agent, "")})
 
         # -------- GPT‑4o 总结 --------
         summary_prompt = "请根据以下结果撰写总结，包含共识、差异和建议：\n\n"
         for agent in plan:
             summary_prompt += f"【{agent}】{self.memory.get(context_id).get(agent, '')}\n\n"
-        res = client.chat.completions.create(model="gpt-4o", messages=[{"role": "user", "content": summary_prompt}])
-        summary = res.choices[0].message.content.strip()
+        summary = cached_chat(client, ANSWER_TTL, model="gpt-4o",
+                              messages=[{"role": "user", "content": summary_prompt}]).strip()
         self.memory.update(context_id, {"summary": summary})
         self.trace.append({"agent": "scheduler", "subtask": "自动生成总结", "output": summary})
 
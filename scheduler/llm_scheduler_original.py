@@ -1,19 +1,47 @@
 import os
 import io
-import requests
-from typing import List, Dict, Tuple, Optional
+import re
+import hashlib
+import time
+import threading
+from collections import defaultdict
+import orjson
+import httpx
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from typing import List, Dict, Tuple, Optional, Any, Iterable, Iterator
 
 import fitz  # PyMuPDF
 from openai import OpenAI
 from mcp.memory import MemoryStore
+from scheduler.llm_cache import cached_agent_call, cached_chat_lines, embed_many, PLAN_TTL
 
 try:
-    from pdf2image import convert_from_bytes
+    from PIL import Image
     import pytesseract
     OCR_AVAILABLE = True
 except ImportError:
     OCR_AVAILABLE = False
 
+# ---------- OCR ----------
+OCR_LANG = "eng+chi_sim"
+OCR_DPI = 300
+
+
+_ocr_doc = None     # OCR 子进程内的 PDF 文档，由 _ocr_init 打开
+
+
+def _ocr_init(data: bytes):
+    # 进程池 initializer：每个子进程只接收并解析一次 PDF，之后任务只传页号
+    global _ocr_doc
+    _ocr_doc = fitz.open(stream=data, filetype="pdf")
+
+
+def _ocr_page(idx: int) -> str:
+    # 顶层函数，供 ProcessPoolExecutor pickle；在子进程内渲染第 idx 页（1 起，灰度）后立即识别
+    pix = _ocr_doc[idx - 1].get_pixmap(dpi=OCR_DPI, colorspace=fitz.csGRAY)
+    return pytesseract.image_to_string(Image.frombytes("L", (pix.width, pix.height), pix.samples), lang=OCR_LANG)
+
+
 # ---------- 配置 ----------
 client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
@@ -22,6 +50,122 @@ REGISTRY: Dict[str, str] = {
     "llama2_agent_2": "http://142.214.185.187:30934/infer"
 }
 
+# ---------- agent 调用：线程池并发，每个端点一个信号量限流 ----------
+AGENT_TIMEOUT = 120
+AGENT_CONCURRENCY = 8    # 单个 agent 端点同时在途的请求数
+AGENT_MAX_WORKERS = 16
+AGENT_CONNECT_TIMEOUT = 5
+_AGENT_SEMS = {ag: threading.BoundedSemaphore(AGENT_CONCURRENCY) for ag in REGISTRY}
+
+# ---------- 规划 system prompt：固定前缀，导入时拼好，命中 OpenAI prompt cache ----------
+_AGENT_LIST = ", ".join(REGISTRY)
+_PLAN_PAGES_SYS = (
+    "你是任务调度专家，根据【任务】将页面分配给下列 agent："
+    + _AGENT_LIST
+    + "。格式：agent: id1,id2 或 agent: m-n。仅返回分配结果。"
+)
+_PLAN_SUBTASKS_SYS = (
+    "你是任务调度专家，请把【任务】拆分为多个可并行子任务，并分配给 agent："
+    + _AGENT_LIST
+    + "。输出每行：agent: 子任务描述。仅返回结果。"
+)
+_SUMMARY_INSTR = "请综合以下各智能体输出，总结共识、差异并提出建议：\n"
+
+# ---------- 页面分配：embedding 相似度 ----------
+# 各 agent 的专长描述。配置后 PDF 页面按与描述的余弦相似度直接分配（一次 embedding 批量请求），
+# 省去 GPT-4o 规划调用；留空（各 agent 同质时）或 embedding 不可用时仍走 GPT-4o。
+AGENT_PROFILE: Dict[str, str] = {}
+EMBED_PAGE_CHARS = 6000      # 单页截断，避免超出 embedding 模型的输入上限
+_agent_emb = None            # AGENT_PROFILE 的 embedding，首次分配时计算
+
+# ---------- 规划解析：预编译正则 ----------
+_LINE_RE = re.compile(r"^\s*([A-Za-z0-9_]+)\s*:\s*(.+?)\s*$")           # agent: 内容
+_RANGE_RE = re.compile(r"^([A-Za-z_]*)(\d+)-[A-Za-z_]*(\d+)$")             # page_3-page_7 / 3-7
+_PAGE_RE = re.compile(r"^[A-Za-z_]*(\d+)$")                                 # page_3 / 3
+
+# 模块级 httpx.Client：跨 dispatch 复用连接；装了 h2 且端点经 ALPN 协商成功时走 HTTP/2，
+# 同一 agent 的并发请求复用一条连接多路传输，否则自动回落 HTTP/1.1
+try:
+    import h2  # noqa: F401
+    HTTP2 = True
+except ImportError:
+    HTTP2 = False
+
+AGENT_RETRIES = 3                                  # 建连失败由 transport 重试，网关 5xx 在 _post_agent 中退避重试
+AGENT_RETRY_STATUS = frozenset({502, 503, 504})
+_JSON_HEADERS = {"Content-Type": "application/json"}
+_CLIENT = httpx.Client(
+    transport=httpx.HTTPTransport(
+        http2=HTTP2, retries=AGENT_RETRIES,
+        limits=httpx.Limits(max_connections=32, max_keepalive_connections=16),
+    ),
+    timeout=httpx.Timeout(AGENT_TIMEOUT, connect=AGENT_CONNECT_TIMEOUT),
+    headers=_JSON_HEADERS,
+)
+
+
+def _dump_payload(payload: Dict[str, Any]) -> bytes:
+    """
+    序列化 agent 载荷。shared_memory 为 bytes 时视为调度开始时预序列化的快照，
+    直接拼到 JSON 对象末尾，同一快照每次 dispatch 只序列化一次。
+    """
+    mem = payload.get("shared_memory")
+    if not isinstance(mem, bytes):
+        return orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS)
+    body = orjson.dumps({k: v for k, v in payload.items() if k != "shared_memory"},
+                        option=orjson.OPT_NON_STR_KEYS)
+    return (body[:-1] + b"," if len(body) > 2 else b"{") + b'"shared_memory":' + mem + b"}"
+
+
+def _page_digest(text: str) -> bytes:
+    """页面文本指纹（blake2b 8 字节），用于同一次调度内的重复页去重。"""
+    return hashlib.blake2b(text.encode(), digest_size=8).digest()
+
+
+def _collect(memory: Dict[str, Any], head: str = "") -> str:
+    """拼接各 agent 输出（【agent】+ 逐条结果），全部写入同一缓冲，只在 getvalue 时复制一次。"""
+    buf = io.StringIO()
+    buf.write(head)
+    sep = ""
+    for ag, mem in memory.items():
+        if ag not in REGISTRY:
+            continue
+        buf.write(f"{sep}【{ag}】\n")
+        for i, v in enumerate(mem.values()):
+            if i:
+                buf.write("\n")
+            buf.write(v)
+        sep = "\n\n"
+    return buf.getvalue()
+
+
+def _post_agent(agent: str, payload: Dict[str, Any], task: str = "", semantic: bool = False) -> Dict[str, Any]:
+    def call():
+        body = _dump_payload(payload)
+        with _AGENT_SEMS[agent]:
+            for attempt in range(AGENT_RETRIES + 1):
+                resp = _CLIENT.post(REGISTRY[agent], content=body)
+                if resp.status_code not in AGENT_RETRY_STATUS or attempt == AGENT_RETRIES:
+                    return orjson.loads(resp.content)
+                time.sleep(0.3 * 2 ** attempt)
+    # 同一任务、同一 memory 快照下的相同 prompt（重试、重复上传）直接复用该端点的历史结果；
+    # 仅 GPT 拆出的子任务（semantic=True）允许语义相近复用，页面 / 文本内容只做精确匹配
+    return cached_agent_call(client, REGISTRY[agent], task, payload.get("prompt", ""),
+                             payload.get("shared_memory"), call, semantic)
+
+
+def _call_agents(calls: Iterable[Tuple[str, Dict[str, Any]]], task: str = "",
+                 semantic: bool = False) -> List[Any]:
+    """
+    并发发送 (agent, payload)；calls 可以是生成器，每产出一个立即提交，
+    规划仍在流式生成时即可开始分发。结果与提交顺序一一对应，异常作为结果返回。
+    task / semantic 透传给 agent 结果缓存（见 cached_agent_call）。
+    """
+    with ThreadPoolExecutor(max_workers=AGENT_MAX_WORKERS) as ex:
+        futures = [ex.submit(_post_agent, agent, payload, task, semantic) for agent, payload in calls]
+    return [f.result() if f.exception() is None else f.exception() for f in futures]
+
+
 
 class LLMScheduler:
     """
@@ -37,89 +181,90 @@ class LLMScheduler:
 
     # ---------- PDF → pages ----------
     @staticmethod
-    def _pdf_pages(data: bytes) -> List[Tuple[str, str]]:
-        pages: List[Tuple[str, str]] = []
+    def _pdf_pages(data: bytes) -> List[str]:
+        """按页序返回文本，第 i 项即 page_{i+1}。"""
         doc = fitz.open(stream=data, filetype="pdf")
-        for idx, page in enumerate(doc, 1):
-            txt = page.get_text("text") or ""
-            if not txt.strip() and OCR_AVAILABLE:
-                img = convert_from_bytes(
-                    data, dpi=300, first_page=idx, last_page=idx
-                )[0]
-                txt = pytesseract.image_to_string(img, lang="eng+chi_sim")
-            pages.append((f"page_{idx}", txt.strip()))
-        return pages
-
-    # ---------- GPT-4o 页面分配 ----------
+        texts = [(page.get_text("text") or "").strip() for page in doc]
+        blanks = [idx for idx, txt in enumerate(texts, 1) if not txt]
+        if blanks and OCR_AVAILABLE:
+            # 只渲染无文本层的页面：子进程按页号渲染后立即 OCR，父进程不持有、不传输渲染图
+            with ProcessPoolExecutor(max_workers=min(len(blanks), os.cpu_count() or 1),
+                                     initializer=_ocr_init, initargs=(data,)) as ex:
+                ocr = ex.map(_ocr_page, blanks)
+                for idx, txt in zip(blanks, ocr):
+                    texts[idx - 1] = txt.strip()
+        return texts
+
+    # ---------- embedding 页面分配 ----------
+    @staticmethod
+    def _assign_pages(pages_text: List[str]) -> Optional[List[Tuple[str, List[int]]]]:
+        """每页分给 embedding 最相近的 agent（argmax(P @ A.T)）；未配置 AGENT_PROFILE 或请求失败时返回 None。"""
+        global _agent_emb
+        agents = [ag for ag in AGENT_PROFILE if ag in REGISTRY]
+        if not agents or not pages_text:
+            return None
+        if _agent_emb is None:
+            _agent_emb = embed_many(client, [AGENT_PROFILE[ag] for ag in agents])
+        pages_emb = embed_many(client, [t[:EMBED_PAGE_CHARS] or " " for t in pages_text])
+        if _agent_emb is None or pages_emb is None:
+            return None
+        plan: Dict[str, List[int]] = defaultdict(list)
+        for i, a in enumerate((pages_emb @ _agent_emb.T).argmax(axis=1).tolist()):
+            plan[agents[a]].append(i)
+        return list(plan.items())
+
+    # ---------- GPT-4o 页面分配（流式） ----------
     def _plan_pages(
-        self, task: str, page_ids: List[str]
-    ) -> Dict[str, List[str]]:
-        ids_str = ", ".join(page_ids)
-        sys_msg = (
-            "你是任务调度专家，根据【任务】将页面分配给下列 agent："
-            + ", ".join(REGISTRY.keys())
-            + "。格式：agent: id1,id2 或 agent: m-n。仅返回分配结果。"
-        )
+        self, task: str, n_pages: int
+    ) -> Iterator[Tuple[str, List[int]]]:
+        """GPT-4o 每生成完一行分配即产出 (agent, [页下标, …])，同一 agent 可出现多次。"""
+        ids_str = ", ".join(f"page_{i}" for i in range(1, n_pages + 1))
         user_msg = f"【任务】{task}\n【页面列表】{ids_str}"
-        rsp = client.chat.completions.create(
+        # 相同任务 + 页面列表（重试 / 重放）直接回放缓存的规划行
+        for ln in cached_chat_lines(
+            client,
+            PLAN_TTL,
             model="gpt-4o",
             messages=[
-                {"role": "system", "content": sys_msg},
+                {"role": "system", "content": _PLAN_PAGES_SYS},
                 {"role": "user", "content": user_msg},
             ],
-        )
-        return self._parse_page_plan(rsp.choices[0].message.content)
-
-    # ---------- GPT-4o 子任务分配 ----------
-    def _plan_subtasks(self, task: str) -> Dict[str, List[str]]:
-        sys_msg = (
-            "你是任务调度专家，请把【任务】拆分为多个可并行子任务，并分配给 agent："
-            + ", ".join(REGISTRY.keys())
-            + "。输出每行：agent: 子任务描述。仅返回结果。"
-        )
-        rsp = client.chat.completions.create(
+        ):
+            item = self._parse_page_plan(ln, n_pages)
+            if item:
+                yield item
+
+    # ---------- GPT-4o 子任务分配（流式） ----------
+    def _plan_subtasks(self, task: str) -> Iterator[Tuple[str, List[str]]]:
+        """每生成完一行 `agent: 子任务描述` 即产出 (agent, [描述])。"""
+        for line in cached_chat_lines(
+            client,
+            PLAN_TTL,
             model="gpt-4o",
             messages=[
-                {"role": "system", "content": sys_msg},
+                {"role": "system", "content": _PLAN_SUBTASKS_SYS},
                 {"role": "user", "content": task},
             ],
-        )
-        mapping: Dict[str, List[str]] = {k: [] for k in REGISTRY}
-        for line in rsp.choices[0].message.content.splitlines():
-            if ":" not in line:
-                continue
-            ag, desc = line.split(":", 1)
-            ag = ag.strip()
-            if ag in REGISTRY:
-                mapping[ag].append(desc.strip())
-        return {k: v for k, v in mapping.items() if v}
+        ):
+            m = _LINE_RE.match(line)
+            if m and m.group(1) in REGISTRY:
+                yield m.group(1), [m.group(2)]
 
-    # ---------- 解析页面 plan ----------
+    # ---------- 解析页面 plan（单行） ----------
     @staticmethod
-    def _parse_page_plan(text: str) -> Dict[str, List[str]]:
-        plan = {k: [] for k in REGISTRY}
-        for ln in text.splitlines():
-            if ":" not in ln:
-                continue
-            ag, ids = ln.split(":", 1)
-            ag = ag.strip()
-            if ag not in REGISTRY:
-                continue
-            ids = ids.replace(" ", "")
-            for part in ids.split(","):
-                if not part:
-                    continue
-                if "-" in part:
-                    s, e = part.split("-")
-                    s_idx = int("".join(filter(str.isdigit, s)))
-                    e_idx = int("".join(filter(str.isdigit, e)))
-                    prefix = "".join(filter(str.isalpha, s)) or "page_"
-                    plan[ag] += [
-                        f"{prefix}{i}" for i in range(s_idx, e_idx + 1)
-                    ]
-                else:
-                    plan[ag].append(part)
-        return {k: v for k, v in plan.items() if v}
+    def _parse_page_plan(ln: str, n_pages: int) -> Optional[Tuple[str, List[int]]]:
+        """page_k 立即转成下标 k-1，越界页丢弃。"""
+        m = _LINE_RE.match(ln)
+        if not m or m.group(1) not in REGISTRY:
+            return None
+        out: List[int] = []
+        for part in m.group(2).replace(" ", "").split(","):
+            r = _RANGE_RE.match(part)
+            if r:
+                out += range(max(int(r.group(2)) - 1, 0), min(int(r.group(3)), n_pages))
+            elif (r := _PAGE_RE.match(part)) and 0 < int(r.group(1)) <= n_pages:
+                out.append(int(r.group(1)) - 1)
+        return (m.group(1), out) if out else None
 
     # ---------- dispatch ----------
     def dispatch(
@@ -135,97 +280,111 @@ class LLMScheduler:
 
         if pdf_data:
             # —— PDF 路径 ——
-            pages = self._pdf_pages(pdf_data)
-            page_map = dict(pages)
-            plan = self._plan_pages(task, [pid for pid, _ in pages])
-
-            # GPT 分配失败时，平均轮转给 agent
-            if not plan:
-                plan = {ag: [] for ag in REGISTRY}
-                for idx, (pid, _) in enumerate(pages):
-                    ag = list(REGISTRY.keys())[idx % len(REGISTRY)]
-                    plan[ag].append(pid)
+            pages_text = self._pdf_pages(pdf_data)
+            sub_ids_source = (self._assign_pages(pages_text)
+                              or self._plan_pages(task, len(pages_text)))
+            sub_id = lambda i: f"page_{i + 1}"
 
-            make_prompt = lambda pid: (
+            make_prompt = lambda i: (
                 f"【任务指令】{task}\n\n"
-                f"【{pid} 原文】\n{page_map.get(pid, '')}"
+                f"【page_{i + 1} 原文】\n{pages_text[i]}"
             )
-            sub_ids_source = plan
 
         elif plain_text is not None:
             # —— 单段文本 ——
-            pages = [("text_1", plain_text.strip())]
-            plan = {list(REGISTRY.keys())[0]: ["text_1"]}
+            pages_text = []
+            sub_id = str
+            sub_ids_source = iter([(list(REGISTRY.keys())[0], ["text_1"])])
             make_prompt = (
                 lambda _:
                 f"【任务指令】{task}\n\n【文本内容】\n{plain_text.strip()}"
             )
-            sub_ids_source = plan
 
         else:
             # —— 仅指令，拆子任务 ——
-            pages = []
-            plan = self._plan_subtasks(task)
+            pages_text = []
+            sub_id = str
+            sub_ids_source = self._plan_subtasks(task)
             make_prompt = (
                 lambda sub:
                 f"【总任务】{task}\n\n【子任务描述】{sub}"
             )
-            sub_ids_source = plan
-
-        # ② 分发
-        for ag, keys in sub_ids_source.items():
-            for key in keys:
-                prompt_text = make_prompt(key)
-                payload = {
-                    "prompt": prompt_text,
-                    "context_id": context_id,
-                    "sub_id": key,
-                    "agent_name": ag,
-                    "shared_memory": self.memory.get(context_id),
-                }
-                try:
-                    resp = requests.post(
-                        REGISTRY[ag], json=payload, timeout=120
-                    )
-                    res_text = resp.json().get("result", "")
-                except Exception as e:
-                    self.trace.append(
-                        {
-                            "agent": ag,
-                            "subtask": key,
-                            "output": f"[❌ 调用失败] {e}",
-                        }
-                    )
-                    continue
-
-                # —— 累积写入 memory —— #
-                ag_mem = self.memory.get(context_id).get(ag, {})
-                if not isinstance(ag_mem, dict):
-                    ag_mem = {}
-                ag_mem[key] = res_text
-                self.memory.update(context_id, {ag: ag_mem})
-                # —— End —— #
-
-                self.trace.append(
-                    {"agent": ag, "subtask": key, "output": res_text}
+
+        # ② 边规划边并发分发（共用调度开始时的 memory 快照）
+        snapshot = self.memory.get(context_id)
+        snap_bytes = orjson.dumps(snapshot, option=orjson.OPT_NON_STR_KEYS)   # 所有请求共用，只序列化一次
+        jobs: List[Tuple[str, str, int]] = []          # (agent, sub_id, 结果下标)
+        seen: Dict[Tuple[str, bytes], int] = {}
+
+        def calls() -> Iterator[Tuple[str, Dict[str, Any]]]:
+            def job(ag: str, key: Any) -> Iterator[Tuple[str, Dict[str, Any]]]:
+                # 同一 agent 的重复内容（签名页、空白页等）只请求一次，结果复制给所有副本
+                sid = sub_id(key)
+                h = (ag, _page_digest(pages_text[key] if isinstance(key, int) else key))
+                if h not in seen:
+                    seen[h] = len(seen)
+                    yield ag, {
+                        "prompt": make_prompt(key),
+                        "context_id": context_id,
+                        "sub_id": sid,
+                        "agent_name": ag,
+                        "shared_memory": snap_bytes,
+                    }
+                jobs.append((ag, sid, seen[h]))
+
+            for ag, keys in sub_ids_source:
+                for key in keys:
+                    yield from job(ag, key)
+            # GPT 分配失败时，平均轮转给 agent
+            if pdf_data and not jobs:
+                agents = list(REGISTRY.keys())
+                for idx in range(len(pages_text)):
+                    yield from job(agents[idx % len(agents)], idx)
+
+        # 只有“仅指令”路径的子任务描述允许语义复用
+        outputs = _call_agents(calls(), task, semantic=not pdf_data and plain_text is None)
+
+        # 按计划顺序收集，扇出结束后一次性写回
+        bulk: Dict[str, Dict[str, str]] = defaultdict(dict)
+        local_trace: List[Dict] = []
+        for ag, key, slot in jobs:
+            output = outputs[slot]
+            try:
+                if isinstance(output, BaseException):
+                    raise output
+                res_text = output.get("result", "")
+            except Exception as e:
+                local_trace.append(
+                    {
+                        "agent": ag,
+                        "subtask": key,
+                        "output": f"[❌ 调用失败] {e}",
+                    }
                 )
+                continue
 
-        # ③ 汇总
-        collected = "\n\n".join(
-            f"【{ag}】\n" + "\n".join(mem.values())
-            for ag, mem in self.memory.get(context_id).items()
-            if ag in REGISTRY
-        )
+            bulk[ag][key] = res_text
+            local_trace.append(
+                {"agent": ag, "subtask": key, "output": res_text}
+            )
 
+        self.trace.extend(local_trace)
+
+        # —— 与已有记录合并后单次 update —— #
+        for ag, ag_mem in bulk.items():
+            prev = snapshot.get(ag)
+            if isinstance(prev, dict):
+                bulk[ag] = {**prev, **ag_mem}
+        self.memory.update(context_id, bulk)
+        memory = self.memory.get(context_id)
+
+        # ③ 汇总
         rsp = client.chat.completions.create(
             model="gpt-4o",
             messages=[
                 {
                     "role": "user",
-                    "content": (
-                        "请综合以下各智能体输出，总结共识、差异并提出建议：\n"
-                        + collected
-                    ),
+                    "content": _collect(memory, _SUMMARY_INSTR),
                 }
             ],
         )
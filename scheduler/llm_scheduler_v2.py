@@ -1,9 +1,15 @@
 import os
-import requests
+import json
+import hashlib
+import time
+import threading
+import orjson
+import httpx
+from concurrent.futures import ThreadPoolExecutor
 from openai import OpenAI
 from mcp.memory import MemoryStore
-import PyPDF2
-import io
+from scheduler.llm_cache import cached_agent_call
+import fitz  # PyMuPDF
 
 client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
@@ -12,6 +18,123 @@ REGISTRY = {
     "llama2_agent_2": "http://142.214.185.187:30934/infer"
 }
 
+# agent 调用：线程池并发，每个端点一个信号量限流
+AGENT_TIMEOUT = 120
+AGENT_CONCURRENCY = 8    # 单个 agent 端点同时在途的请求数
+AGENT_MAX_WORKERS = 16
+AGENT_CONNECT_TIMEOUT = 5
+_AGENT_SEMS = {ag: threading.BoundedSemaphore(AGENT_CONCURRENCY) for ag in REGISTRY}
+
+# 规划 system prompt 只含固定内容（任务放在 user 消息），前缀稳定以命中 OpenAI prompt cache
+_PLAN_PDF_SYS = (
+    "你是一个任务调度专家，请根据任务内容，将PDF页面拆解为子任务，并分别分配给以下 agent 中的一个：\n"
+    "- llama2_agent\n- llama2_agent_2\n"
+    "请根据用户给出的任务描述与PDF页面数，生成合理的任务分配，明确指出每个代理负责哪些页面。\n"
+    "请明确列出每个代理负责的页面范围，并且确保合理分配：\n"
+    "按 JSON 返回 assignments，键为代理名称，值为页面范围 {start, end}（闭区间，从 1 开始）；未分配的代理填 0。"
+)
+_PLAN_TEXT_SYS = (
+    "你是一个任务调度专家，请根据任务内容，将其拆解为子任务，并分别分配给以下 agent 中的一个：\n"
+    "- llama2_agent\n- llama2_agent_2\n"
+    "请根据用户给出的任务描述，生成合理的任务分配。"
+)
+
+# 页面分配走结构化输出：每个 agent 一个整数页面范围 {start, end}，不分配则为 0
+_PAGE_RANGE_SCHEMA = {
+    "type": "object",
+    "properties": {"start": {"type": "integer"}, "end": {"type": "integer"}},
+    "required": ["start", "end"],
+    "additionalProperties": False,
+}
+PLAN_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "assignments": {
+            "type": "object",
+            "properties": {ag: _PAGE_RANGE_SCHEMA for ag in REGISTRY},
+            "required": list(REGISTRY),
+            "additionalProperties": False,
+        }
+    },
+    "required": ["assignments"],
+    "additionalProperties": False,
+}
+_PLAN_RESPONSE_FORMAT = {"type": "json_schema",
+                         "json_schema": {"name": "plan", "schema": PLAN_SCHEMA, "strict": True}}
+
+# 模块级 httpx.Client：跨 dispatch 复用连接；装了 h2 且端点经 ALPN 协商成功时走 HTTP/2，
+# 同一 agent 的并发请求复用一条连接多路传输，否则自动回落 HTTP/1.1
+try:
+    import h2  # noqa: F401
+    HTTP2 = True
+except ImportError:
+    HTTP2 = False
+
+AGENT_RETRIES = 3                                  # 建连失败由 transport 重试，网关 5xx 在 _post_agent 中退避重试
+AGENT_RETRY_STATUS = frozenset({502, 503, 504})
+_JSON_HEADERS = {"Content-Type": "application/json"}
+_CLIENT = httpx.Client(
+    transport=httpx.HTTPTransport(
+        http2=HTTP2, retries=AGENT_RETRIES,
+        limits=httpx.Limits(max_connections=32, max_keepalive_connections=16),
+    ),
+    timeout=httpx.Timeout(AGENT_TIMEOUT, connect=AGENT_CONNECT_TIMEOUT),
+    headers=_JSON_HEADERS,
+)
+
+
+def _dump_payload(payload):
+    """
+    序列化 agent 载荷。shared_memory 为 bytes 时视为调度开始时预序列化的快照，
+    直接拼到 JSON 对象末尾，同一快照每次 dispatch 只序列化一次。
+    """
+    mem = payload.get("shared_memory")
+    if not isinstance(mem, bytes):
+        return orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS)
+    body = orjson.dumps({k: v for k, v in payload.items() if k != "shared_memory"},
+                        option=orjson.OPT_NON_STR_KEYS)
+    return (body[:-1] + b"," if len(body) > 2 else b"{") + b'"shared_memory":' + mem + b"}"
+
+
+def _page_digest(text):
+    """页面文本指纹（blake2b 8 字节），用于同一次调度内的重复页去重。"""
+    return hashlib.blake2b(text.encode(), digest_size=8).digest()
+
+
+def _post_agent(agent, payload, task=""):
+    def call():
+        body = _dump_payload(payload)
+        with _AGENT_SEMS[agent]:
+            for attempt in range(AGENT_RETRIES + 1):
+                resp = _CLIENT.post(REGISTRY[agent], content=body)
+                if resp.status_code not in AGENT_RETRY_STATUS or attempt == AGENT_RETRIES:
+                    return orjson.loads(resp.content)
+                time.sleep(0.3 * 2 ** attempt)
+    # 同一任务、同一 memory 快照下的相同页面（重试、重复上传）直接复用该端点的历史结果；页面内容不做语义复用
+    return cached_agent_call(client, REGISTRY[agent], task, payload.get("subtask", ""),
+                             payload.get("shared_memory"), call)
+
+
+def _call_agents(calls, on_done=None, task=""):
+    """
+    并发发送全部 (agent, payload)，结果与 calls 一一对应，异常作为结果返回。task 参与 agent 结果缓存的键。
+    on_done(i, result) 在第 i 个结果就绪时于工作线程中回调。
+    """
+    if not calls:
+        return []
+    with ThreadPoolExecutor(max_workers=min(len(calls), AGENT_MAX_WORKERS)) as ex:
+        futures = [ex.submit(_post_agent, agent, payload, task) for agent, payload in calls]
+        if on_done is not None:
+            for i, f in enumerate(futures):
+                f.add_done_callback(lambda f, i=i: on_done(i, f.exception() or f.result()))
+    return [f.result() if f.exception() is None else f.exception() for f in futures]
+
+
+def _summarize(prompt):
+    res = client.chat.completions.create(model="gpt-4o", messages=[{"role": "user", "content": prompt}])
+    return res.choices[0].message.content.strip()
+
+
 class LLMScheduler:
     def __init__(self):
         self.memory = MemoryStore()
@@ -19,12 +142,9 @@ class LLMScheduler:
 
     # PDF拆分函数
     def split_pdf(self, pdf_file):
-        pdf_reader = PyPDF2.PdfReader(io.BytesIO(pdf_file))
-        pages = []
-        for i in range(len(pdf_reader.pages)):
-            page = pdf_reader.pages[i].extract_text()
-            pages.append((i + 1, page))  # 返回页号和页内容
-        return pages
+        # 每次 dispatch 只在 plan() 中解析一次，页面随计划返回给 dispatch 复用，无需跨调用缓存 PDF 字节
+        with fitz.open(stream=pdf_file, filetype="pdf") as doc:
+            return [(i + 1, page.get_text("text")) for i, page in enumerate(doc)]  # 返回 (页号, 页内容)
 
     def plan(self, user_task, is_pdf=False, pdf_file=None):
         if is_pdf:
@@ -32,38 +152,20 @@ class LLMScheduler:
             total_pages = len(pdf_pages)
 
             messages = [
-                {
-                    "role": "system",
-                    "content": (
-                        "你是一个任务调度专家，请根据任务内容，将PDF页面拆解为子任务，并分别分配给以下 agent 中的一个：\n"
-                        "- llama2_agent\n- llama2_agent_2\n"
-                        "请根据以下信息，生成合理的任务分配，明确指出每个代理负责哪些页面：\n"
-                        f"任务描述：{user_task}\n"
-                        f"PDF页面数：{total_pages}\n"
-                        "请明确列出每个代理负责的页面范围，并且确保合理分配，格式如下：\n"
-                        "代理名称: 页面范围（例如：llama2_agent: 1-3，llama2_agent_2: 4-5）"
-                    )
-                },
-                {"role": "user", "content": f"任务描述：{user_task}"}
+                {"role": "system", "content": _PLAN_PDF_SYS},
+                {"role": "user", "content": f"任务描述：{user_task}\nPDF页面数：{total_pages}"}
             ]
 
             res = client.chat.completions.create(
                 model="gpt-4o",
-                messages=messages
+                messages=messages,
+                response_format=_PLAN_RESPONSE_FORMAT
             )
             task_assignment = res.choices[0].message.content.strip()
-            return self.parse_task_assignment(task_assignment)
+            return self.parse_task_assignment(task_assignment), pdf_pages
         else:
             messages = [
-                {
-                    "role": "system",
-                    "content": (
-                        "你是一个任务调度专家，请根据任务内容，将其拆解为子任务，并分别分配给以下 agent 中的一个：\n"
-                        "- llama2_agent\n- llama2_agent_2\n"
-                        "请根据以下信息，生成合理的任务分配：\n"
-                        f"任务描述：{user_task}\n"
-                    )
-                },
+                {"role": "system", "content": _PLAN_TEXT_SYS},
                 {"role": "user", "content": f"任务：{user_task}"}
             ]
             res = client.chat.completions.create(
@@ -71,71 +173,130 @@ class LLMScheduler:
                 messages=messages
             )
             lines = res.choices[0].message.content.strip().splitlines()
-            return {
-                l.split(":")[0].strip(): ":".join(l.split(":")[1:]).strip()
-                for l in lines if ":" in l and l.split(":")[0].strip() in REGISTRY
-            }
+            plan = {}
+            for l in lines:
+                k, sep, v = l.partition(":")   # 单次扫描，不再为每行 split 三次
+                k = k.strip()
+                if sep and k in REGISTRY:
+                    plan[k] = v.strip()
+            return plan, ()
 
     def parse_task_assignment(self, task_assignment):
+        """
+        解析 GPT-4o 结构化输出 {"assignments": {agent: {"start": 1, "end": 3}}} 为 {agent: (start, end)}；
+        丢弃未注册的 agent 以及非整数、从 0 开始或首尾颠倒的范围，JSON 不合法时返回空计划
+        """
+        try:
+            assignments = json.loads(task_assignment)["assignments"]
+        except (ValueError, KeyError, TypeError):
+            return {}
         plan = {}
-        lines = task_assignment.splitlines()
-        for line in lines:
-            if ":" in line:
-                agent, pages = line.split(":")
-                plan[agent.strip()] = pages.strip()
+        for agent, rng in assignments.items():
+            if agent not in REGISTRY or not isinstance(rng, dict):
+                continue
+            start, end = rng.get("start"), rng.get("end")
+            if type(start) is int and type(end) is int and 1 <= start <= end:
+                plan[agent] = (start, end)
         return plan
 
     def dispatch(self, context_id, task, is_pdf=False, pdf_file=None):
-        plan = self.plan(task, is_pdf, pdf_file)
+        plan, pdf_pages = self.plan(task, is_pdf, pdf_file)   # 复用 plan 中已拆好的页面
 
+        # 收集全部子任务后并发发送，共用调度开始时的 memory 快照
+        memory = self.memory.get(context_id)
+        jobs = []
         for agent, page_range in plan.items():
-            memory = self.memory.get(context_id)
-
-            page_start, page_end = map(int, page_range.split('-'))
-            pdf_pages = self.split_pdf(pdf_file)
+            page_start, page_end = page_range
             relevant_pages = pdf_pages[page_start - 1:page_end]
+            jobs += [(agent, subtask[1]) for subtask in relevant_pages]
+
+        mem_bytes = orjson.dumps(memory, option=orjson.OPT_NON_STR_KEYS)   # 所有请求共用，只序列化一次
+        # 同一 agent 的重复页面（签名页、空白页等）只请求一次，结果复制给所有副本
+        seen, calls, slots = {}, [], []
+        for agent, content in jobs:
+            h = (agent, _page_digest(content))
+            if h not in seen:
+                seen[h] = len(calls)
+                calls.append((agent, {
+                    "context_id": context_id,
+                    "agent_name": agent,
+                    "subtask": content,
+                    "shared_memory": mem_bytes
+                }))
+            slots.append(seen[h])
+        # 总结只看各 agent 在 memory 中的最终值（后面的页面覆盖前面的）：每个 agent 计划内最后一个请求完成后，
+        # 即按已完成的结果推测性地提前发出总结请求，与扇出尾部重叠；
+        # 已有请求失败时不推测，最终 prompt 一致才采用，否则取消推测请求
+        done, spec = {}, {}
+        summary_pool = ThreadPoolExecutor(max_workers=1)   # 推测性总结单独一个线程，随本次 dispatch 关闭
+        need = set({agent: slot for (agent, _), slot in zip(jobs, slots)}.values())
+        lock = threading.Lock()
+
+        def summary_prompt_of(mem):
+            return "请根据以下多位智能体的分析结果，撰写一个总结报告，内容包括共识、差异、你的建议：\n\n" + "".join(
+                f"【{agent}】：{mem.get(agent, '')}\n\n" for agent in plan)
 
-            for subtask in relevant_pages:
-                try:
-                    res = requests.post(REGISTRY[agent], json={
-                        "context_id": context_id,
-                        "agent_name": agent,
-                        "subtask": subtask[1],
-                        "shared_memory": memory
-                    })
-                    output = res.json()
-                    # ——兼容改动开始——
-                    if "memory_update" in output:
-                        mem = output["memory_update"]
-                    else:
-                        mem = {agent: output.get("result", "")}
-                    # ——兼容改动结束——
-                except Exception as e:
-                    mem = {}
-                    self.trace.append({
-                        "agent": agent,
-                        "subtask": subtask[1],
-                        "output": f"[❌ 调用失败] {str(e)}"
-                    })
-                    continue
-
-                self.memory.update(context_id, mem)
-                self.trace.append({
+        def on_done(slot, result):
+            with lock:
+                done[slot] = result
+                need.discard(slot)
+                if not isinstance(result, dict):
+                    spec["failed"] = True   # 有请求失败时最终 memory 无法预判，不再推测
+                if need or spec:
+                    return
+                mem = dict(memory)
+                for (agent, _), s in zip(jobs, slots):
+                    out = done.get(s)
+                    if isinstance(out, dict):
+                        mem.update(out["memory_update"] if "memory_update" in out
+                                   else {agent: out.get("result", "")})
+                spec["prompt"] = summary_prompt_of(mem)
+                spec["future"] = summary_pool.submit(_summarize, spec["prompt"])
+
+        outputs = _call_agents(calls, on_done, task)
+
+        # 按计划顺序写回，保证 memory 覆盖顺序与串行时一致
+        bulk = {}
+        local_trace = []
+        for (agent, content), slot in zip(jobs, slots):
+            output = outputs[slot]
+            try:
+                if isinstance(output, BaseException):
+                    raise output
+                # ——兼容改动开始——
+                if "memory_update" in output:
+                    mem = output["memory_update"]
+                else:
+                    mem = {agent: output.get("result", "")}
+                # ——兼容改动结束——
+            except Exception as e:
+                local_trace.append({
                     "agent": agent,
-                    "subtask": subtask[1],
-                    "output": mem.get(agent, f"[⚠️ memory_update 中缺少 '{agent}']")
+                    "subtask": content,
+                    "output": f"[❌ 调用失败] {str(e)}"
                 })
+                continue
+
+            bulk.update(mem)
+            local_trace.append({
+                "agent": agent,
+                "subtask": content,
+                "output": mem.get(agent, f"[⚠️ memory_update 中缺少 '{agent}']")
+            })
 
-        summary_prompt = "请根据以下多位智能体的分析结果，撰写一个总结报告，内容包括共识、差异、你的建议：\n\n"
-        for agent in plan.keys():
-            content = self.memory.get(context_id).get(agent, "")
-            summary_prompt += f"【{agent}】：{content}\n\n"
+        self.trace.extend(local_trace)           # trace 与 memory 都在扇出结束后一次性写回
+        self.memory.update(context_id, bulk)
+        memory = self.memory.get(context_id)
 
-        res = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[{"role": "user", "content": summary_prompt}]
-        )
-        summary = res.choices[0].message.content.strip()
+        summary_prompt = summary_prompt_of(memory)
+        with lock:
+            spec["closed"] = True                # 此后完成的回调不再发起推测
+        fut = spec.get("future")
+        if fut is not None and spec["prompt"] != summary_prompt:
+            fut.cancel()                         # 推测落空：尚未开始的请求直接取消
+            fut = None
+        summary_pool.shutdown(wait=False)
+        summary = fut.result() if fut is not None else _summarize(summary_prompt)
         self.memory.update(context_id, {"summary": summary})
         self.trace.append({
             "agent": "scheduler",
@@ -1,12 +1,17 @@
 import os
-import io
-import requests
-from typing import List, Tuple, Dict
+import re
+import hashlib
+import random
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Tuple, Dict, Any, Optional
+
+import httpx
 
-import PyPDF2  # 纯粹文本抽取即可满足需求
 from openai import OpenAI
 
 from mcp.memory import MemoryStore
+from scheduler.llm_cache import cached_plan, cached_chat, PLAN_TTL, ANSWER_TTL, RESPONSE_SIM_THRESHOLD
 
 # ==================== 初始化 ====================
 
@@ -20,6 +25,66 @@ REGISTRY: Dict[str, str] = {
 
 CHUNK_SIZE = 1200  # 每个文本块最大 tokens 左右（粗估字符）
 
+AGENT_TIMEOUT = 60
+AGENT_CONCURRENCY = 8    # 单个 agent 端点同时在途的请求数
+AGENT_TRIES = 3
+AGENT_BACKOFF = 0.5      # 第 i 次重试前等待 AGENT_BACKOFF * 2**i 秒（另加少量抖动）
+
+# REGISTRY 静态，规划用的 system prompt 导入时拼好：首条消息每次逐字相同，可变内容只放 user 消息，
+# 满足 OpenAI 自动提示缓存的前缀匹配条件
+_PLAN_SYS = (
+    "你是任务调度专家。下面给出若干文本块 ID，请将它们合理分配给下列 agent，输出格式严格如下：\n"
+    "agent_name: id1,id2 或 agent_name: start-end（闭区间）\n"
+    "agent 必须只用以下名字：" + ", ".join(REGISTRY.keys()) + "。\n"
+    "只返回分配结果，不要添加额外解释。"
+)
+
+
+async def _retry(fn, tries: int = AGENT_TRIES, base: float = AGENT_BACKOFF):
+    """执行协程工厂 fn()；网络错误 / 超时 / 5xx 时指数退避重试，await asyncio.sleep 不阻塞其他子任务。"""
+    for i in range(tries):
+        try:
+            return await fn()
+        except httpx.HTTPError:          # TimeoutException、HTTPStatusError 均为其子类
+            if i == tries - 1:
+                raise
+            await asyncio.sleep(base * 2 ** i + random.random() * 0.1)
+
+
+_RANGE_RE = re.compile(r"^([A-Za-z_]*)(\d+)-[A-Za-z_]*(\d+)$")   # chunk_3-chunk_7 / 3-7
+
+
+def _content_digest(text: str) -> bytes:
+    """子任务内容指纹（blake2b 16 字节），用于同一次调度内的重复请求去重。"""
+    return hashlib.blake2b(text.encode(), digest_size=16).digest()
+
+
+# ---------- 汇总前压缩 ----------
+SUMMARY_BUDGET_CHARS = 24000        # 汇总 prompt 中各 agent 输出的总字符预算
+SUMMARY_MAP_CHARS = 48000           # 单个 agent 提炼时最多送入的字符数
+SUMMARY_MAP_MODEL = "gpt-4o-mini"
+_MAP_INSTR = "请提炼以下智能体输出的要点（保留关键事实、结论与分歧），用简洁的 Markdown 返回：\n"
+
+
+def _condense(blocks: Dict[str, str]) -> Dict[str, str]:
+    """
+    各 agent 输出总长超出 SUMMARY_BUDGET_CHARS 时，把超过平均份额的输出并发提炼为要点（map），
+    再交给最终汇总（reduce）；未超预算时原样返回，汇总 prompt 与缓存键不变。
+    """
+    if sum(map(len, blocks.values())) <= SUMMARY_BUDGET_CHARS:
+        return blocks
+    share = SUMMARY_BUDGET_CHARS // len(blocks)
+    long = [ag for ag, txt in blocks.items() if len(txt) > share]
+
+    def brief(ag: str) -> str:
+        return cached_chat(client, ANSWER_TTL, model=SUMMARY_MAP_MODEL, messages=[
+            {"role": "user", "content": _MAP_INSTR + blocks[ag][:SUMMARY_MAP_CHARS]}
+        ]).strip()
+
+    with ThreadPoolExecutor(max_workers=len(long)) as ex:
+        return {**blocks, **dict(zip(long, ex.map(brief, long)))}
+
+
 # ==================== Scheduler 实现 ====================
 
 class LLMScheduler:
@@ -37,44 +102,52 @@ class LLMScheduler:
 
     # -------- PDF 读取 & 切分 --------
     def _pdf_to_text(self, pdf_binary: bytes) -> str:
-        reader = PyPDF2.PdfReader(io.BytesIO(pdf_binary))
-        pages = [p.extract_text() or "" for p in reader.pages]
-        return "\n\n".join(pages)
+        try:
+            import fitz  # PyMuPDF：按需导入，纯文本调度不加载
+        except ImportError:
+            import pypdfium2 as pdfium   # 未安装 PyMuPDF（AGPL）时退回 pdfium（Apache）
+            pdf = pdfium.PdfDocument(pdf_binary)
+            try:
+                return "\n\n".join(page.get_textpage().get_text_range() for page in pdf)
+            finally:
+                pdf.close()
+        with fitz.open(stream=pdf_binary, filetype="pdf") as doc:
+            return "\n\n".join(p.get_text("text") for p in doc)
 
     def _split_text(self, text: str) -> List[Tuple[str, str]]:
         """把大文本按 CHUNK_SIZE 粗分，返回 [(chunk_id, chunk_text), ...]"""
         chunks, idx, buf = [], 1, []
+        size = 0                      # 恒等于 len("\n".join(buf))，避免每段重新拼接
         for para in text.splitlines():
-            if len("\n".join(buf) + para) > CHUNK_SIZE:
+            if size + len(para) > CHUNK_SIZE:
                 chunks.append((f"chunk_{idx}", "\n".join(buf).strip()))
                 idx += 1
                 buf = [para]
+                size = len(para)
             else:
+                size += len(para) + (1 if buf else 0)
                 buf.append(para)
         if buf:
             chunks.append((f"chunk_{idx}", "\n".join(buf).strip()))
         return chunks
 
     # -------- 任务规划 --------
+    @cached_plan(client, RESPONSE_SIM_THRESHOLD)     # 只把全部 chunk 分给 agent，相近任务可复用
     def _plan(self, user_task: str, chunks: List[Tuple[str, str]]):
         """调用 GPT‑4o，将 chunk ID 分给各 agent。
         GPT 只看到 chunk_id，避免暴露全文；同时指明要返回 "agent: id1,id2" 或 "agent: id_start-id_end"""        
         chunk_ids = ", ".join(cid for cid, _ in chunks)
-        sys_prompt = (
-            "你是任务调度专家。下面给出若干文本块 ID，请将它们合理分配给下列 agent，输出格式严格如下：\n"
-            "agent_name: id1,id2 或 agent_name: start-end（闭区间）\n"
-            "agent 必须只用以下名字：" + ", ".join(REGISTRY.keys()) + "。\n"
-            "只返回分配结果，不要添加额外解释。"
-        )
         user_prompt = (
             f"用户任务：{user_task}\n"
             f"待分配文本块：{chunk_ids}"
         )
-        res = client.chat.completions.create(
+        content = cached_chat(
+            client, PLAN_TTL,
             model="gpt-4o",
-            messages=[{"role": "system", "content": sys_prompt}, {"role": "user", "content": user_prompt}]
+            messages=[{"role": "system", "content": _PLAN_SYS}, {"role": "user", "content": user_prompt}],
+            on_usage=self._usage_logger("任务规划"),
         )
-        return self._parse_plan(res.choices[0].message.content)
+        return self._parse_plan(content)
 
     def _parse_plan(self, plan_text: str) -> Dict[str, List[str]]:
         plan: Dict[str, List[str]] = {k: [] for k in REGISTRY}
@@ -88,18 +161,57 @@ class LLMScheduler:
             ids = ids.replace(" ", "")
             id_list = []
             for part in ids.split(','):
-                if '-' in part:
-                    start, end = part.split('-')
-                    prefix = ''.join(filter(str.isalpha, start)) or 'chunk_'
-                    s_num = int(''.join(filter(str.isdigit, start)))
-                    e_num = int(''.join(filter(str.isdigit, end)))
-                    id_list += [f"{prefix}{i}" for i in range(s_num, e_num + 1)]
-                else:
+                r = _RANGE_RE.match(part)
+                if r:
+                    prefix = r.group(1) or 'chunk_'
+                    id_list += [f"{prefix}{i}" for i in range(int(r.group(2)), int(r.group(3)) + 1)]
+                elif '-' not in part:          # 无法解析的区间直接丢弃
                     id_list.append(part)
             plan[agent] += id_list
         # 清理空 agent
         return {k: v for k, v in plan.items() if v}
 
+    # -------- OpenAI 提示缓存统计 --------
+    def _usage_logger(self, name: str) -> Callable[[Any], None]:
+        """返回 on_usage 回调：把本次请求命中 OpenAI 提示缓存的 token 数记入 trace。"""
+        def log(usage: Any):
+            details = getattr(usage, "prompt_tokens_details", None)
+            cached = getattr(details, "cached_tokens", None) or 0
+            self.trace.append({"agent": "scheduler", "subtask": f"{name}（提示缓存）",
+                               "output": f"cached_tokens={cached}/{usage.prompt_tokens}"})
+        return log
+
+    # -------- 并发调用 /infer --------
+    async def _call_agent(self, http: httpx.AsyncClient, sem: asyncio.Semaphore,
+                          agent: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        async def post():
+            async with sem:              # 退避等待期间不占用并发名额
+                resp = await http.post(REGISTRY[agent], json=payload)
+            if resp.status_code >= 500:
+                resp.raise_for_status()
+            return resp.json()
+        return await _retry(post)
+
+    async def _call_agents(self, calls: List[Tuple[str, Dict[str, Any]]],
+                           contents: Optional[List[str]] = None) -> List[Any]:
+        """
+        并发发送全部 (agent, payload)；每个端点一个 Semaphore，异常作为结果返回。
+        给出 contents（与 calls 一一对应的块内容）时，同一 agent 的相同内容只请求一次，结果共享给所有副本。
+        """
+        sems = {ag: asyncio.Semaphore(AGENT_CONCURRENCY) for ag in REGISTRY}
+        inflight: Dict[Tuple[str, bytes], "asyncio.Future[Any]"] = {}
+        async with httpx.AsyncClient(timeout=AGENT_TIMEOUT) as http:
+            futs = []
+            for i, (ag, payload) in enumerate(calls):
+                key = (ag, _content_digest(contents[i])) if contents is not None else None
+                fut = inflight.get(key) if key else None
+                if fut is None:
+                    fut = asyncio.ensure_future(self._call_agent(http, sems[ag], ag, payload))
+                    if key:
+                        inflight[key] = fut
+                futs.append(fut)
+            return await asyncio.gather(*futs, return_exceptions=True)
+
     # -------- 分发执行 --------
     def dispatch(self, context_id: str, user_task: str, pdf_binary: bytes):
         full_text = self._pdf_to_text(pdf_binary)
@@ -107,8 +219,11 @@ class LLMScheduler:
         plan = self._plan(user_task, chunks)
         id2text = dict(chunks)
 
+        # 先收集全部子任务，共用调度开始时的 memory 快照
+        memory_snapshot = self.memory.get(context_id)
+        calls: List[Tuple[str, str, Dict[str, Any]]] = []
+        contents: List[str] = []
         for agent, id_list in plan.items():
-            memory_snapshot = self.memory.get(context_id)
             for cid in id_list:
                 context_text = id2text.get(cid, "")
                 payload = {
@@ -119,29 +234,36 @@ class LLMScheduler:
                     "chunk_id": cid,
                     "shared_memory": memory_snapshot
                 }
-                try:
-                    resp = requests.post(REGISTRY[agent], json=payload, timeout=60)
-                    out = resp.json()
-                    # 兼容 result / memory_update
-                    mem = out.get("memory_update") or {agent: out.get("result", "")}
-                except Exception as e:
-                    self.trace.append({"agent": agent, "subtask": cid, "output": f"[❌ 调用失败] {e}"})
-                    continue
-
-                self.memory.update(context_id, mem)
-                self.trace.append({"agent": agent, "subtask": cid, "output": mem.get(agent, "")})
+                calls.append((agent, cid, payload))
+                contents.append(context_text)
+        results = asyncio.run(self._call_agents([(ag, p) for ag, _, p in calls], contents)) if calls else []
+
+        # 结果按计划顺序合并，gather 结束后一次性写回 memory
+        bulk: Dict[str, Any] = {}
+        for (agent, cid, _), out in zip(calls, results):
+            try:
+                if isinstance(out, BaseException):
+                    raise out
+                # 兼容 result / memory_update
+                mem = out.get("memory_update") or {agent: out.get("result", "")}
+            except Exception as e:
+                self.trace.append({"agent": agent, "subtask": cid, "output": f"[❌ 调用失败] {e}"})
+                continue
+
+            bulk.update(mem)
+            self.trace.append({"agent": agent, "subtask": cid, "output": mem.get(agent, "")})
+        self.memory.update(context_id, bulk)
 
         # -------- 汇总总结 --------
-        summary_prompt = "请根据以下多位智能体的分析结果，撰写总结，包含共识、差异和建议：\n\n"
-        for agent in plan:
-            summary_prompt += f"【{agent}】{self.memory.get(context_id).get(agent, '')}\n\n"
-        res = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[{"role": "user", "content": summary_prompt}]
+        state = self.memory.get(context_id)
+        blocks = _condense({agent: str(state.get(agent, "")) for agent in plan})
+        summary_prompt = "请根据以下多位智能体的分析结果，撰写总结，包含共识、差异和建议：\n\n" + "".join(
+            f"【{agent}】{blocks[agent]}\n\n" for agent in plan
         )
-        summary = res.choices[0].message.content.strip()
+        summary = cached_chat(client, ANSWER_TTL, model="gpt-4o",
+                              messages=[{"role": "user", "content": summary_prompt}]).strip()
         self.memory.update(context_id, {"summary": summary})
         self.trace.append({"agent": "scheduler", "subtask": "自动生成总结", "output": summary})
 
-        return self.memory.get(context_id), self.trace
+        return state, self.trace         # state 即 memory 中的同一 dict，已含 summary
 
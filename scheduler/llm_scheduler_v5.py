@@ -1,12 +1,17 @@
 import os
-import io
-import requests
-from typing import List, Tuple, Dict
+import re
+import hashlib
+import random
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Tuple, Dict, Any, Optional
+
+import httpx
 
-import PyPDF2
 from openai import OpenAI
 
 from mcp.memory import MemoryStore
+from scheduler.llm_cache import cached_plan, cached_chat, PLAN_TTL, ANSWER_TTL
 
 # ==================== 配置 ====================
 client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
@@ -18,6 +23,71 @@ REGISTRY: Dict[str, str] = {
 
 CHUNK_SIZE = 1200  # 约 ~400 token
 
+AGENT_TIMEOUT = 60
+AGENT_CONCURRENCY = 8    # 单个 agent 端点同时在途的请求数
+AGENT_TRIES = 3
+AGENT_BACKOFF = 0.5      # 第 i 次重试前等待 AGENT_BACKOFF * 2**i 秒（另加少量抖动）
+
+# REGISTRY 静态，规划用的 system prompt 导入时拼好：首条消息每次逐字相同，可变内容只放 user 消息，
+# 满足 OpenAI 自动提示缓存的前缀匹配条件
+_PLAN_SYS = (
+    "你是任务调度专家。\n"
+    "给定：\n"
+    "1. 完整的用户任务文本；\n"
+    "2. 若干文件材料文本块的 ID 列表（不含正文内容）。\n\n"
+    "如果材料为空，说明任务仅基于用户文本。\n"
+    "如果材料不为空，你需要判断这些材料是否与任务相关，并将相关 group 分配给以下 agent，输出格式：\n"
+    "agent_name: id1,id2 或 agent_name: start-end\n"
+    "agent 仅能使用：" + ", ".join(REGISTRY.keys()) + "\n"
+    "若认为无需处理文件材料，可返回空分配或仅针对用户文本提出方案。除分配结果外不要输出解释。"
+)
+
+
+async def _retry(fn, tries: int = AGENT_TRIES, base: float = AGENT_BACKOFF):
+    """执行协程工厂 fn()；网络错误 / 超时 / 5xx 时指数退避重试，await asyncio.sleep 不阻塞其他子任务。"""
+    for i in range(tries):
+        try:
+            return await fn()
+        except httpx.HTTPError:          # TimeoutException、HTTPStatusError 均为其子类
+            if i == tries - 1:
+                raise
+            await asyncio.sleep(base * 2 ** i + random.random() * 0.1)
+
+
+_RANGE_RE = re.compile(r"^([A-Za-z_]*)(\d+)-[A-Za-z_]*(\d+)$")   # group_3-group_7 / 3-7
+
+
+def _content_digest(text: str) -> bytes:
+    """子任务内容指纹（blake2b 16 字节），用于同一次调度内的重复请求去重。"""
+    return hashlib.blake2b(text.encode(), digest_size=16).digest()
+
+
+# ---------- 汇总前压缩 ----------
+SUMMARY_BUDGET_CHARS = 24000        # 汇总 prompt 中各 agent 输出的总字符预算
+SUMMARY_MAP_CHARS = 48000           # 单个 agent 提炼时最多送入的字符数
+SUMMARY_MAP_MODEL = "gpt-4o-mini"
+_MAP_INSTR = "请提炼以下智能体输出的要点（保留关键事实、结论与分歧），用简洁的 Markdown 返回：\n"
+
+
+def _condense(blocks: Dict[str, str]) -> Dict[str, str]:
+    """
+    各 agent 输出总长超出 SUMMARY_BUDGET_CHARS 时，把超过平均份额的输出并发提炼为要点（map），
+    再交给最终汇总（reduce）；未超预算时原样返回，汇总 prompt 与缓存键不变。
+    """
+    if sum(map(len, blocks.values())) <= SUMMARY_BUDGET_CHARS:
+        return blocks
+    share = SUMMARY_BUDGET_CHARS // len(blocks)
+    long = [ag for ag, txt in blocks.items() if len(txt) > share]
+
+    def brief(ag: str) -> str:
+        return cached_chat(client, ANSWER_TTL, model=SUMMARY_MAP_MODEL, messages=[
+            {"role": "user", "content": _MAP_INSTR + blocks[ag][:SUMMARY_MAP_CHARS]}
+        ]).strip()
+
+    with ThreadPoolExecutor(max_workers=len(long)) as ex:
+        return {**blocks, **dict(zip(long, ex.map(brief, long)))}
+
+
 # ==================== Scheduler ====================
 class LLMScheduler:
     """
@@ -38,46 +108,40 @@ class LLMScheduler:
     # ---------- 工具 ----------
     @staticmethod
     def _pdf_to_text(pdf_bytes: bytes) -> str:
-        reader = PyPDF2.PdfReader(io.BytesIO(pdf_bytes))
-        return "\n\n".join(p.extract_text() or "" for p in reader.pages)
+        import fitz  # PyMuPDF：按需导入，纯文本调度不加载
+        with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+            return "\n\n".join(p.get_text("text") for p in doc)
 
     @staticmethod
     def _split_text(text: str) -> List[Tuple[str, str]]:
         chunks, idx, buf = [], 1, []
+        size = 0                      # 恒等于 len("\n".join(buf))，避免每段重新拼接
         for para in text.splitlines():
-            if len("\n".join(buf) + para) > CHUNK_SIZE:
+            if size + len(para) > CHUNK_SIZE:
                 chunks.append((f"group_{idx}", "\n".join(buf).strip()))
                 idx += 1
                 buf = [para]
+                size = len(para)
             else:
+                size += len(para) + (1 if buf else 0)
                 buf.append(para)
         if buf:
             chunks.append((f"group_{idx}", "\n".join(buf).strip()))
         return chunks
 
     # ---------- 让 GPT‑4o 做任务判断 + 分配 ----------
+    @cached_plan(client)
     def _plan_with_gpt(self, user_text: str, groups: List[Tuple[str, str]]) -> Dict[str, List[str]]:
         group_ids = ", ".join(cid for cid, _ in groups) if groups else "(无)"
-        sys_prompt = (
-            "你是任务调度专家。\n"
-            "给定：\n"
-            "1. 完整的用户任务文本；\n"
-            "2. 若干文件材料文本块的 ID 列表（不含正文内容）。\n\n"
-            "如果材料为空，说明任务仅基于用户文本。\n"
-            "如果材料不为空，你需要判断这些材料是否与任务相关，并将相关 group 分配给以下 agent，输出格式：\n"
-            "agent_name: id1,id2 或 agent_name: start-end\n"
-            "agent 仅能使用：" + ", ".join(REGISTRY.keys()) + "\n"
-            "若认为无需处理文件材料，可返回空分配或仅针对用户文本提出方案。除分配结果外不要输出解释。"
-        )
         user_prompt = (
             f"【用户任务全文】\n{user_text}\n\n"
             f"【文件材料 group ID 列表】{group_ids}"
         )
-        res = client.chat.completions.create(model="gpt-4o", messages=[
-            {"role": "system", "content": sys_prompt},
+        content = cached_chat(client, PLAN_TTL, model="gpt-4o", messages=[
+            {"role": "system", "content": _PLAN_SYS},
             {"role": "user", "content": user_prompt}
-        ])
-        return self._parse_plan(res.choices[0].message.content)
+        ], on_usage=self._usage_logger("任务规划"))
+        return self._parse_plan(content)
 
     @staticmethod
     def _parse_plan(text: str) -> Dict[str, List[str]]:
@@ -93,16 +157,55 @@ class LLMScheduler:
             for part in ids.split(','):
                 if not part:
                     continue
-                if '-' in part:
-                    start, end = part.split('-')
-                    prefix = ''.join(filter(str.isalpha, start)) or 'group_'
-                    s = int(''.join(filter(str.isdigit, start)))
-                    e = int(''.join(filter(str.isdigit, end)))
-                    plan[agent] += [f"{prefix}{i}" for i in range(s, e + 1)]
-                else:
+                r = _RANGE_RE.match(part)
+                if r:
+                    prefix = r.group(1) or 'group_'
+                    plan[agent] += [f"{prefix}{i}" for i in range(int(r.group(2)), int(r.group(3)) + 1)]
+                elif '-' not in part:          # 无法解析的区间直接丢弃
                     plan[agent].append(part)
         return {k: v for k, v in plan.items() if v}
 
+    # ---------- OpenAI 提示缓存统计 ----------
+    def _usage_logger(self, name: str) -> Callable[[Any], None]:
+        """返回 on_usage 回调：把本次请求命中 OpenAI 提示缓存的 token 数记入 trace。"""
+        def log(usage: Any):
+            details = getattr(usage, "prompt_tokens_details", None)
+            cached = getattr(details, "cached_tokens", None) or 0
+            self.trace.append({"agent": "scheduler", "subtask": f"{name}（提示缓存）",
+                               "output": f"cached_tokens={cached}/{usage.prompt_tokens}"})
+        return log
+
+    # ---------- 并发调用 /infer ----------
+    async def _call_agent(self, http: httpx.AsyncClient, sem: asyncio.Semaphore,
+                          agent: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        async def post():
+            async with sem:              # 退避等待期间不占用并发名额
+                resp = await http.post(REGISTRY[agent], json=payload)
+            if resp.status_code >= 500:
+                resp.raise_for_status()
+            return resp.json()
+        return await _retry(post)
+
+    async def _call_agents(self, calls: List[Tuple[str, Dict[str, Any]]],
+                           contents: Optional[List[str]] = None) -> List[Any]:
+        """
+        并发发送全部 (agent, payload)；每个端点一个 Semaphore，异常作为结果返回。
+        给出 contents（与 calls 一一对应的块内容）时，同一 agent 的相同内容只请求一次，结果共享给所有副本。
+        """
+        sems = {ag: asyncio.Semaphore(AGENT_CONCURRENCY) for ag in REGISTRY}
+        inflight: Dict[Tuple[str, bytes], "asyncio.Future[Any]"] = {}
+        async with httpx.AsyncClient(timeout=AGENT_TIMEOUT) as http:
+            futs = []
+            for i, (ag, payload) in enumerate(calls):
+                key = (ag, _content_digest(contents[i])) if contents is not None else None
+                fut = inflight.get(key) if key else None
+                if fut is None:
+                    fut = asyncio.ensure_future(self._call_agent(http, sems[ag], ag, payload))
+                    if key:
+                        inflight[key] = fut
+                futs.append(fut)
+            return await asyncio.gather(*futs, return_exceptions=True)
+
     # ---------- 主入口 ----------
     def dispatch(self, context_id: str, text: str, file_bytes: bytes | None = None):
         groups: List[Tuple[str, str]] = []
@@ -113,10 +216,11 @@ class LLMScheduler:
         plan = self._plan_with_gpt(text, groups)
         id2text = dict(groups)
 
+        # 先收集全部子任务，共用调度开始时的 memory 快照（GPT 可能返回空 id 列表，自然跳过）
+        snap = self.memory.get(context_id)
+        calls: List[Tuple[str, str, Dict[str, Any]]] = []
+        contents: List[str] = []
         for agent, gid_list in plan.items():
-            snap = self.memory.get(context_id)
-            if not gid_list:  # 允许 GPT 返回空 id 列表，此时可跳过
-                continue
             for gid in gid_list:
                 payload = {
                     "context_id": context_id,
@@ -126,25 +230,35 @@ class LLMScheduler:
                     "chunk_id": gid,
                     "shared_memory": snap
                 }
-                try:
-                    resp = requests.post(REGISTRY[agent], json=payload, timeout=60)
-                    out = resp.json()
-                    mem = out.get("memory_update") or {agent: out.get("result", "")}
-                except Exception as e:
-                    self.trace.append({"agent": agent, "subtask": gid, "output": f"[❌ 调用失败] {e}"})
-                    continue
+                calls.append((agent, gid, payload))
+                contents.append(payload["context"])
+        results = asyncio.run(self._call_agents([(ag, p) for ag, _, p in calls], contents)) if calls else []
 
-                self.memory.update(context_id, mem)
-                self.trace.append({"agent": agent, "subtask": gid, "output": mem.get(agent, "")})
+        # 结果按计划顺序合并，gather 结束后一次性写回 memory
+        bulk: Dict[str, Any] = {}
+        for (agent, gid, _), out in zip(calls, results):
+            try:
+                if isinstance(out, BaseException):
+                    raise out
+                mem = out.get("memory_update") or {agent: out.get("result", "")}
+            except Exception as e:
+                self.trace.append({"agent": agent, "subtask": gid, "output": f"[❌ 调用失败] {e}"})
+                continue
+
+            bulk.update(mem)
+            self.trace.append({"agent": agent, "subtask": gid, "output": mem.get(agent, "")})
+        self.memory.update(context_id, bulk)
 
         # -------- 让 GPT‑4o 总结 --------
-        summary_prompt = "请根据以下结果撰写总结，包含共识、差异和建议：\n\n"
-        for agent in plan:
-            summary_prompt += f"【{agent}】{self.memory.get(context_id).get(agent, '')}\n\n"
-        res = client.chat.completions.create(model="gpt-4o", messages=[{"role": "user", "content": summary_prompt}])
-        summary = res.choices[0].message.content.strip()
+        state = self.memory.get(context_id)
+        blocks = _condense({agent: str(state.get(agent, "")) for agent in plan})
+        summary_prompt = "请根据以下结果撰写总结，包含共识、差异和建议：\n\n" + "".join(
+            f"【{agent}】{blocks[agent]}\n\n" for agent in plan
+        )
+        summary = cached_chat(client, ANSWER_TTL, model="gpt-4o",
+                              messages=[{"role": "user", "content": summary_prompt}]).strip()
         self.memory.update(context_id, {"summary": summary})
         self.trace.append({"agent": "scheduler", "subtask": "自动生成总结", "output": summary})
 
-        return self.memory.get(context_id), self.trace
+        return state, self.trace         # state 即 memory 中的同一 dict，已含 summary
 
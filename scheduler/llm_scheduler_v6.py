@@ -1,20 +1,54 @@
 import os
-import io
-import requests
-from typing import List, Tuple, Dict
+import re
+import hashlib
+import random
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Tuple, Dict, Any, Optional
+
+import httpx
 
-import pdfplumber  # 更稳定的 PDF 文本抽取
 from openai import OpenAI
 from mcp.memory import MemoryStore
+from scheduler.llm_cache import cached_plan, cached_chat, PLAN_TTL, ANSWER_TTL
 
-# 如需 OCR：确保系统已安装 tesseract，且 pip 安装 pdf2image、pytesseract
+# 如需 OCR：确保系统已安装 tesseract，且 pip 安装 tesserocr 或 pytesseract（均依赖 Pillow）
 try:
-    from pdf2image import convert_from_bytes
-    import pytesseract
+    import tesserocr        # 进程内 OCR：tessdata 常驻，免去每页 fork tesseract
+except ImportError:
+    tesserocr = None
+
+try:
+    from PIL import Image
+    if tesserocr is None:
+        import pytesseract
     OCR_AVAILABLE = True
 except ImportError:
     OCR_AVAILABLE = False
 
+OCR_LANG = "eng+chi_sim"
+OCR_DPI = 300
+OCR_MAX_WORKERS = 8
+
+
+def _ocr_batch(pdf: bytes, idxs: List[int]) -> List[str]:
+    """
+    一个工作线程处理一批页面（下标 0 起）：PDF 只打开一次，逐页渲染后立即识别，同一时刻只持有一张渲染图；
+    tesserocr 可用时整批共用一个实例，否则退回 pytesseract 逐页调用。
+    """
+    import fitz
+    with fitz.open(stream=pdf, filetype="pdf") as doc:
+        images = (LLMScheduler._render_page(doc[i]) for i in idxs)
+        if tesserocr is not None:
+            with tesserocr.PyTessBaseAPI(lang=OCR_LANG) as api:
+                out = []
+                for img in images:
+                    api.SetImage(img)
+                    out.append(api.GetUTF8Text())
+                return out
+        return [pytesseract.image_to_string(img, lang=OCR_LANG) for img in images]
+
+
 client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
 REGISTRY: Dict[str, str] = {
@@ -22,6 +56,65 @@ REGISTRY: Dict[str, str] = {
     "llama2_agent_2": "http://142.214.185.187:30934/infer"
 }
 
+AGENT_TIMEOUT = 120
+AGENT_CONCURRENCY = 8    # 单个 agent 端点同时在途的请求数
+AGENT_TRIES = 3
+AGENT_BACKOFF = 0.5      # 第 i 次重试前等待 AGENT_BACKOFF * 2**i 秒（另加少量抖动）
+
+# REGISTRY 静态，规划用的 system prompt 导入时拼好：首条消息每次逐字相同，可变内容只放 user 消息，
+# 满足 OpenAI 自动提示缓存的前缀匹配条件
+_PLAN_SYS = (
+    "你是任务调度专家。请根据【用户任务全文】和【PDF 页面 ID 列表】判断哪些页面与任务相关，"
+    "并将相关页面分配给以下 agent，格式：agent: id1,id2 或 agent: start-end。\n"
+    + "可用 agent：" + ", ".join(REGISTRY.keys())
+)
+
+
+async def _retry(fn, tries: int = AGENT_TRIES, base: float = AGENT_BACKOFF):
+    """执行协程工厂 fn()；网络错误 / 超时 / 5xx 时指数退避重试，await asyncio.sleep 不阻塞其他子任务。"""
+    for i in range(tries):
+        try:
+            return await fn()
+        except httpx.HTTPError:          # TimeoutException、HTTPStatusError 均为其子类
+            if i == tries - 1:
+                raise
+            await asyncio.sleep(base * 2 ** i + random.random() * 0.1)
+
+
+_RANGE_RE = re.compile(r"^([A-Za-z_]*)(\d+)-[A-Za-z_]*(\d+)$")   # page_3-page_7 / 3-7
+
+
+def _content_digest(text: str) -> bytes:
+    """子任务内容指纹（blake2b 16 字节），用于同一次调度内的重复请求去重。"""
+    return hashlib.blake2b(text.encode(), digest_size=16).digest()
+
+
+# ---------- 汇总前压缩 ----------
+SUMMARY_BUDGET_CHARS = 24000        # 汇总 prompt 中各 agent 输出的总字符预算
+SUMMARY_MAP_CHARS = 48000           # 单个 agent 提炼时最多送入的字符数
+SUMMARY_MAP_MODEL = "gpt-4o-mini"
+_MAP_INSTR = "请提炼以下智能体输出的要点（保留关键事实、结论与分歧），用简洁的 Markdown 返回：\n"
+
+
+def _condense(blocks: Dict[str, str]) -> Dict[str, str]:
+    """
+    各 agent 输出总长超出 SUMMARY_BUDGET_CHARS 时，把超过平均份额的输出并发提炼为要点（map），
+    再交给最终汇总（reduce）；未超预算时原样返回，汇总 prompt 与缓存键不变。
+    """
+    if sum(map(len, blocks.values())) <= SUMMARY_BUDGET_CHARS:
+        return blocks
+    share = SUMMARY_BUDGET_CHARS // len(blocks)
+    long = [ag for ag, txt in blocks.items() if len(txt) > share]
+
+    def brief(ag: str) -> str:
+        return cached_chat(client, ANSWER_TTL, model=SUMMARY_MAP_MODEL, messages=[
+            {"role": "user", "content": _MAP_INSTR + blocks[ag][:SUMMARY_MAP_CHARS]}
+        ]).strip()
+
+    with ThreadPoolExecutor(max_workers=len(long)) as ex:
+        return {**blocks, **dict(zip(long, ex.map(brief, long)))}
+
+
 class LLMScheduler:
     """按 **PDF 页** 维度拆分，抽不到文本时自动 OCR。"""
 
@@ -32,31 +125,42 @@ class LLMScheduler:
     # ---------- PDF → [(page_id, text)] ----------
     @staticmethod
     def _pdf_pages(pdf_bytes: bytes) -> List[Tuple[str, str]]:
-        pages = []
-        with pdfplumber.open(io.BytesIO(pdf_bytes)) as pdf:
-            for idx, page in enumerate(pdf.pages, start=1):
-                text = page.extract_text() or ""
-                # 若纯空白，尝试 OCR
-                if not text.strip() and OCR_AVAILABLE:
-                    img = convert_from_bytes(pdf_bytes, first_page=idx, last_page=idx)[0]
-                    text = pytesseract.image_to_string(img, lang="eng+chi_sim")
-                pages.append((f"page_{idx}", text.strip()))
-        return pages
+        """
+        文本层逐页直接读取；无文本层的页面交给线程池，由工作线程逐页渲染后立即 OCR（不预先渲染全部页面）：
+        装了 tesserocr 时在本进程内识别（识别期间释放 GIL），否则由 pytesseract 逐页启动 tesseract 子进程。
+        """
+        import fitz  # PyMuPDF：按需导入，纯文本调度不加载
+        with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+            texts = [page.get_text("text") or "" for page in doc]
+            blanks = [i for i, t in enumerate(texts) if not t.strip()] if OCR_AVAILABLE else []
+        if blanks:
+            n = min(OCR_MAX_WORKERS, len(blanks))      # 每个线程处理一批页面下标，tesserocr 只初始化 n 次
+            with ThreadPoolExecutor(max_workers=n) as ex:
+                batches = [blanks[j::n] for j in range(n)]
+                for batch, out in zip(batches, ex.map(_ocr_batch, [pdf_bytes] * n, batches)):
+                    for i, txt in zip(batch, out):
+                        texts[i] = txt
+        return [(f"page_{idx}", t.strip()) for idx, t in enumerate(texts, 1)]
+
+    @staticmethod
+    def _render_page(page):
+        # 直接渲染灰度图：tesseract 只用灰度，无需再用 pdf2image 重新解析整份 PDF
+        import fitz
+        pix = page.get_pixmap(dpi=OCR_DPI, colorspace=fitz.csGRAY)
+        return Image.frombytes("L", (pix.width, pix.height), pix.samples)
 
     # ---------- GPT‑4o 分配 ----------
+    @cached_plan(client)
     def _plan_with_gpt(self, user_text: str, page_ids: List[str]) -> Dict[str, List[str]]:
         id_list = ", ".join(page_ids) if page_ids else "(无页面)"
-        sys_prompt = (
-            "你是任务调度专家。请根据【用户任务全文】和【PDF 页面 ID 列表】判断哪些页面与任务相关，"
-            "并将相关页面分配给以下 agent，格式：agent: id1,id2 或 agent: start-end。\n"
-            + "可用 agent：" + ", ".join(REGISTRY.keys())
-        )
         user_prompt = f"【用户任务全文】\n{user_text}\n\n【PDF 页面 ID 列表】{id_list}"
-        res = client.chat.completions.create(
+        content = cached_chat(
+            client, PLAN_TTL,
             model="gpt-4o",
-            messages=[{"role": "system", "content": sys_prompt}, {"role": "user", "content": user_prompt}]
+            messages=[{"role": "system", "content": _PLAN_SYS}, {"role": "user", "content": user_prompt}],
+            on_usage=self._usage_logger("任务规划"),
         )
-        return self._parse_plan(res.choices[0].message.content)
+        return self._parse_plan(content)
 
     @staticmethod
     def _parse_plan(text: str) -> Dict[str, List[str]]:
@@ -72,24 +176,66 @@ class LLMScheduler:
             for part in ids.split(','):
                 if not part:
                     continue
-                if '-' in part:
-                    start, end = part.split('-')
-                    prefix = ''.join(filter(str.isalpha, start)) or 'page_'
-                    s = int(''.join(filter(str.isdigit, start)))
-                    e = int(''.join(filter(str.isdigit, end)))
-                    plan[agent] += [f"{prefix}{i}" for i in range(s, e + 1)]
-                else:
+                r = _RANGE_RE.match(part)
+                if r:
+                    prefix = r.group(1) or 'page_'
+                    plan[agent] += [f"{prefix}{i}" for i in range(int(r.group(2)), int(r.group(3)) + 1)]
+                elif '-' not in part:          # 无法解析的区间直接丢弃
                     plan[agent].append(part)
         return {k: v for k, v in plan.items() if v}
 
+    # ---------- OpenAI 提示缓存统计 ----------
+    def _usage_logger(self, name: str) -> Callable[[Any], None]:
+        """返回 on_usage 回调：把本次请求命中 OpenAI 提示缓存的 token 数记入 trace。"""
+        def log(usage: Any):
+            details = getattr(usage, "prompt_tokens_details", None)
+            cached = getattr(details, "cached_tokens", None) or 0
+            self.trace.append({"agent": "scheduler", "subtask": f"{name}（提示缓存）",
+                               "output": f"cached_tokens={cached}/{usage.prompt_tokens}"})
+        return log
+
+    # ---------- 并发调用 /infer ----------
+    async def _call_agent(self, http: httpx.AsyncClient, sem: asyncio.Semaphore,
+                          agent: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        async def post():
+            async with sem:              # 退避等待期间不占用并发名额
+                resp = await http.post(REGISTRY[agent], json=payload)
+            if resp.status_code >= 500:
+                resp.raise_for_status()
+            return resp.json()
+        return await _retry(post)
+
+    async def _call_agents(self, calls: List[Tuple[str, Dict[str, Any]]],
+                           contents: Optional[List[str]] = None) -> List[Any]:
+        """
+        并发发送全部 (agent, payload)；每个端点一个 Semaphore，异常作为结果返回。
+        给出 contents（与 calls 一一对应的块内容）时，同一 agent 的相同内容只请求一次，结果共享给所有副本。
+        """
+        sems = {ag: asyncio.Semaphore(AGENT_CONCURRENCY) for ag in REGISTRY}
+        inflight: Dict[Tuple[str, bytes], "asyncio.Future[Any]"] = {}
+        async with httpx.AsyncClient(timeout=AGENT_TIMEOUT) as http:
+            futs = []
+            for i, (ag, payload) in enumerate(calls):
+                key = (ag, _content_digest(contents[i])) if contents is not None else None
+                fut = inflight.get(key) if key else None
+                if fut is None:
+                    fut = asyncio.ensure_future(self._call_agent(http, sems[ag], ag, payload))
+                    if key:
+                        inflight[key] = fut
+                futs.append(fut)
+            return await asyncio.gather(*futs, return_exceptions=True)
+
     # ---------- 主流程 ----------
     def dispatch(self, context_id: str, text: str, file_bytes: bytes | None = None):
         pages = self._pdf_pages(file_bytes) if file_bytes else []
         page_map = dict(pages)
         plan = self._plan_with_gpt(text, [pid for pid, _ in pages])
 
+        # 先收集全部页面请求，共用调度开始时的 memory 快照
+        snap = self.memory.get(context_id)
+        calls: List[Tuple[str, str, Dict[str, Any]]] = []
+        contents: List[str] = []
         for agent, pid_list in plan.items():
-            snap = self.memory.get(context_id)
             for pid in pid_list:
                 prompt = (
                     "你是一名 GAIA benchmark 专家。请根据下列任务指令和对应 PDF 页面内容回答：\n"
@@ -102,26 +248,36 @@ class LLMScheduler:
                     "agent_name": agent,
                     "shared_memory": snap
                 }
-                try:
-                    resp = requests.post(REGISTRY[agent], json=payload, timeout=120)
-                    jr = resp.json()
-                    clean = jr.get("result", "").replace("[INST]", "").replace("[/INST]", "").strip()
-                    mem = jr.get("memory_update") or {agent: clean}
-                except Exception as e:
-                    self.trace.append({"agent": agent, "subtask": pid, "output": f"[❌ 调用失败] {e}"})
-                    continue
+                calls.append((agent, pid, payload))
+                contents.append(page_map.get(pid, ""))
+        results = asyncio.run(self._call_agents([(ag, p) for ag, _, p in calls], contents)) if calls else []
+
+        # 结果按计划顺序合并，gather 结束后一次性写回 memory
+        bulk: Dict[str, Any] = {}
+        for (agent, pid, _), out in zip(calls, results):
+            try:
+                if isinstance(out, BaseException):
+                    raise out
+                clean = out.get("result", "").replace("[INST]", "").replace("[/INST]", "").strip()
+                mem = out.get("memory_update") or {agent: clean}
+            except Exception as e:
+                self.trace.append({"agent": agent, "subtask": pid, "output": f"[❌ 调用失败] {e}"})
+                continue
 
-                self.memory.update(context_id, mem)
-                self.trace.append({"agent": agent, "subtask": pid, "output": mem.get(agent, "")})
+            bulk.update(mem)
+            self.trace.append({"agent": agent, "subtask": pid, "output": mem.get(agent, "")})
+        self.memory.update(context_id, bulk)
 
         # ---------- 总结 ----------
-        summary_prompt = "请基于各 agent 输出撰写 GAIA 风格总结（共识/差异/建议）：\n\n"
-        for ag in plan:
-            summary_prompt += f"【{ag}】{self.memory.get(context_id).get(ag, '')}\n\n"
-        res = client.chat.completions.create(model="gpt-4o", messages=[{"role": "user", "content": summary_prompt}])
-        summary = res.choices[0].message.content.strip()
+        state = self.memory.get(context_id)
+        blocks = _condense({ag: str(state.get(ag, "")) for ag in plan})
+        summary_prompt = "请基于各 agent 输出撰写 GAIA 风格总结（共识/差异/建议）：\n\n" + "".join(
+            f"【{ag}】{blocks[ag]}\n\n" for ag in plan
+        )
+        summary = cached_chat(client, ANSWER_TTL, model="gpt-4o",
+                              messages=[{"role": "user", "content": summary_prompt}]).strip()
         self.memory.update(context_id, {"summary": summary})
         self.trace.append({"agent": "scheduler", "subtask": "自动生成总结", "output": summary})
 
-        return self.memory.get(context_id), self.trace
+        return state, self.trace         # state 即 memory 中的同一 dict，已含 summary
 
@@ -1,25 +1,145 @@
-import os, requests
+import os, re, random, asyncio, hashlib
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from typing import List, Dict, Tuple, Optional, Callable, Any
 
-import fitz  # PyMuPDF
-from openai import OpenAI
+import httpx
+
+from openai import OpenAI, AsyncOpenAI
 from mcp.memory import MemoryStore
+from scheduler.llm_cache import (cached_plan, acached_chat, acached_chat_stream, PLAN_TTL, ANSWER_TTL,
+                                 RESPONSE_SIM_THRESHOLD)
+
+try:
+    import tesserocr        # 进程内 OCR：tessdata 常驻，免去每页 fork tesseract
+except ImportError:
+    tesserocr = None
 
 try:
-    from pdf2image import convert_from_bytes
-    import pytesseract
+    from PIL import Image
+    if tesserocr is None:
+        import pytesseract
     OCR_AVAILABLE = True
 except ImportError:
     OCR_AVAILABLE = False
 
+OCR_LANG = "eng+chi_sim"
+OCR_DPI = 300
+OCR_MAX_WORKERS = 8
+
+
+def _ocr_batch(pdf: bytes, idxs: List[int]) -> List[str]:
+    """
+    一个工作线程处理一批页面（下标 0 起）：PDF 只打开一次，逐页渲染后立即识别，同一时刻只持有一张渲染图；
+    tesserocr 可用时整批共用一个实例，否则退回 pytesseract 逐页调用。
+    """
+    import fitz
+    with fitz.open(stream=pdf, filetype="pdf") as doc:
+        images = (LLMScheduler._render_page(doc[i]) for i in idxs)
+        if tesserocr is not None:
+            with tesserocr.PyTessBaseAPI(lang=OCR_LANG) as api:
+                out = []
+                for img in images:
+                    api.SetImage(img)
+                    out.append(api.GetUTF8Text())
+                return out
+        return [pytesseract.image_to_string(img, lang=OCR_LANG) for img in images]
+
+
 # ---------- OpenAI ----------
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# AsyncOpenAI 的连接池绑定事件循环，而 dispatch 每次 asyncio.run 都是新循环，故每次调度新建一个（见 _dispatch）
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+client = OpenAI(api_key=OPENAI_API_KEY)   # 同步客户端仅供规划缓存计算 embedding
+SPLIT_MODEL = "gpt-4o-mini"               # 拆分判断只需回答 yes / no，用小模型
+# 置 1 时拆分判断与 GPT-4o 子任务规划并发发出（省一个往返，但无需拆分时规划请求照样计费）；默认先判断再规划
+SPECULATIVE_PLAN = os.getenv("SPECULATIVE_PLAN") == "1"
+
+
+@lru_cache(maxsize=1)
+def _split_logit_bias() -> Dict[str, int]:
+    """'yes' / 'no' 首个 token 的 logit 加 100，保证唯一的输出 token 只能是二者之一；缺 tiktoken 时不加约束。"""
+    try:
+        import tiktoken                   # 首次使用可能需下载词表，故不在导入时计算
+        enc = tiktoken.encoding_for_model(SPLIT_MODEL)
+    except Exception:
+        return {}
+    return {str(enc.encode(w)[0]): 100 for w in ("yes", "no")}
 
 # ---------- Agent Registry ----------
 REGISTRY: Dict[str, str] = {
     "llama2_agent":   "http://136.59.129.136:34517/infer",
     "llama2_agent_2": "http://142.214.185.187:30934/infer",
 }
+AGENT_TIMEOUT = 120
+AGENT_CONCURRENCY = 8    # 单个 agent 端点同时在途的请求数
+AGENT_TRIES = 3
+AGENT_BACKOFF = 0.5      # 第 i 次重试前等待 AGENT_BACKOFF * 2**i 秒（另加少量抖动）
+# agent 端支持批量协议时置 1：每个 agent 只 POST 一次 {items: [{sub_id, prompt}, ...]}，
+# 响应 {results: [...]} 与 items 一一对应，每项形如单条 /infer 的响应 {result: ...}；默认仍逐条 POST
+AGENT_BATCH = os.getenv("AGENT_BATCH") == "1"
+
+# REGISTRY 静态，规划用的 system prompt 导入时拼好：首条消息每次逐字相同，可变内容只放 user 消息，
+# 满足 OpenAI 自动提示缓存的前缀匹配条件
+_SPLIT_SYS = (
+    "你是任务复杂度评估器，仅回答 'yes' 或 'no'。"
+    "当且仅当【任务】需要被拆分为子任务才能高效完成时回答 'yes'，"
+    "否则回答 'no'。"
+)
+_PLAN_PAGES_SYS = (
+    "你是任务调度专家，根据【任务】将页面分配给下列 agent："
+    + ", ".join(REGISTRY.keys())
+    + "。格式：agent: id1,id2 或 agent: m-n。仅返回分配结果。"
+)
+_PLAN_SUBTASKS_SYS = (
+    "你是任务调度专家，请把【任务】拆分为多个可并行子任务，并分配给 agent："
+    + ", ".join(REGISTRY.keys())
+    + "。输出每行：agent: 子任务描述。仅返回结果。"
+)
+
+
+async def _retry(fn, tries: int = AGENT_TRIES, base: float = AGENT_BACKOFF):
+    """执行协程工厂 fn()；网络错误 / 超时 / 5xx 时指数退避重试，await asyncio.sleep 不阻塞其他子任务。"""
+    for i in range(tries):
+        try:
+            return await fn()
+        except httpx.HTTPError:          # TimeoutException、HTTPStatusError 均为其子类
+            if i == tries - 1:
+                raise
+            await asyncio.sleep(base * 2 ** i + random.random() * 0.1)
+
+
+_RANGE_RE = re.compile(r"^([A-Za-z_]*)(\d+)-[A-Za-z_]*(\d+)$")   # page_3-page_7 / 3-7
+
+
+def _content_digest(text: str) -> bytes:
+    """子任务内容指纹（blake2b 16 字节），用于同一次调度内的重复请求去重。"""
+    return hashlib.blake2b(text.encode(), digest_size=16).digest()
+
+
+# ---------- 汇总前压缩 ----------
+SUMMARY_BUDGET_CHARS = 24000        # 汇总 prompt 中各 agent 输出的总字符预算
+SUMMARY_MAP_CHARS = 48000           # 单个 agent 提炼时最多送入的字符数
+SUMMARY_MAP_MODEL = "gpt-4o-mini"
+_MAP_INSTR = "请提炼以下智能体输出的要点（保留关键事实、结论与分歧），用简洁的 Markdown 返回：\n"
+
+
+async def _condense(ai: AsyncOpenAI, blocks: Dict[str, str]) -> Dict[str, str]:
+    """
+    各 agent 输出总长超出 SUMMARY_BUDGET_CHARS 时，把超过平均份额的输出并发提炼为要点（map），
+    再交给最终汇总（reduce）；未超预算时原样返回，汇总 prompt 与缓存键不变。
+    """
+    if sum(map(len, blocks.values())) <= SUMMARY_BUDGET_CHARS:
+        return blocks
+    share = SUMMARY_BUDGET_CHARS // len(blocks)
+    long = [ag for ag, txt in blocks.items() if len(txt) > share]
+    briefs = await asyncio.gather(*[
+        acached_chat(ai, ANSWER_TTL, model=SUMMARY_MAP_MODEL, messages=[
+            {"role": "user", "content": _MAP_INSTR + blocks[ag][:SUMMARY_MAP_CHARS]}
+        ]) for ag in long
+    ])
+    return {**blocks, **{ag: b.strip() for ag, b in zip(long, briefs)}}
+
 
 # ------------------------------------------------------------
 
@@ -27,7 +147,7 @@ REGISTRY: Dict[str, str] = {
 class LLMScheduler:
     """
     调度流程：
-    1. 判断任务是否需要拆分（PDF 必拆；纯文本由 GPT-4o 判断）。
+    1. 判断任务是否需要拆分（PDF 必拆；纯文本由 gpt-4o-mini 判断）。
     2. 无需拆分 → GPT-4o 直接生成 Markdown。
     3. 需要拆分 → 推送子任务列表；分配子任务给各 agent；逐步推送进度。
     4. Agent 全部完成后，再汇总为最终 Markdown。
@@ -40,71 +160,76 @@ class LLMScheduler:
     # ---------- PDF → pages ----------
     @staticmethod
     def _pdf_pages(data: bytes) -> List[Tuple[str, str]]:
-        pages: List[Tuple[str, str]] = []
-        doc = fitz.open(stream=data, filetype="pdf")
-        for idx, page in enumerate(doc, 1):
-            txt = page.get_text("text") or ""
-            if not txt.strip() and OCR_AVAILABLE:
-                img = convert_from_bytes(
-                    data, dpi=300, first_page=idx, last_page=idx
-                )[0]
-                txt = pytesseract.image_to_string(img, lang="eng+chi_sim")
-            pages.append((f"page_{idx}", txt.strip()))
-        return pages
+        """
+        文本层逐页直接读取；无文本层的页面交给线程池，由工作线程逐页渲染后立即 OCR（不预先渲染全部页面）：
+        装了 tesserocr 时在本进程内识别（识别期间释放 GIL），否则由 pytesseract 逐页启动 tesseract 子进程。
+        """
+        import fitz  # PyMuPDF：按需导入，纯文本调度不加载
+        with fitz.open(stream=data, filetype="pdf") as doc:
+            texts = [page.get_text("text") or "" for page in doc]
+            blanks = [i for i, t in enumerate(texts) if not t.strip()] if OCR_AVAILABLE else []
+        if blanks:
+            n = min(OCR_MAX_WORKERS, len(blanks))      # 每个线程处理一批页面下标，tesserocr 只初始化 n 次
+            with ThreadPoolExecutor(max_workers=n) as ex:
+                batches = [blanks[j::n] for j in range(n)]
+                for batch, out in zip(batches, ex.map(_ocr_batch, [data] * n, batches)):
+                    for i, txt in zip(batch, out):
+                        texts[i] = txt
+        return [(f"page_{idx}", t.strip()) for idx, t in enumerate(texts, 1)]
+
+    @staticmethod
+    def _render_page(page):
+        # 直接渲染灰度图：tesseract 只用灰度，无需再用 pdf2image 重新解析整份 PDF
+        import fitz
+        pix = page.get_pixmap(dpi=OCR_DPI, colorspace=fitz.csGRAY)
+        return Image.frombytes("L", (pix.width, pix.height), pix.samples)
 
     # ---------- 判断是否需要拆分 ----------
-    def _need_split(self, task: str) -> bool:
-        rsp = client.chat.completions.create(
-            model="gpt-4o",
+    @cached_plan(client)
+    async def _need_split(self, task: str, *, ai: AsyncOpenAI) -> bool:
+        bias = _split_logit_bias()
+        answer = await acached_chat(
+            ai, PLAN_TTL,
+            model=SPLIT_MODEL,
             messages=[
-                {
-                    "role": "system",
-                    "content": (
-                        "你是任务复杂度评估器，仅回答 'yes' 或 'no'。"
-                        "当且仅当【任务】需要被拆分为子任务才能高效完成时回答 'yes'，"
-                        "否则回答 'no'。"
-                    ),
-                },
+                {"role": "system", "content": _SPLIT_SYS},
                 {"role": "user", "content": f"【任务】{task}"},
             ],
             max_tokens=1,
+            on_usage=self._usage_logger("拆分判断"),
+            **({"logit_bias": bias} if bias else {}),
         )
-        answer = rsp.choices[0].message.content.strip().lower()
-        return answer.startswith("y")
+        return answer.strip().lower().startswith("y")
 
     # ---------- GPT-4o 页面分配 ----------
-    def _plan_pages(self, task: str, page_ids: List[str]) -> Dict[str, List[str]]:
+    @cached_plan(client, RESPONSE_SIM_THRESHOLD)     # 只分配页面，相近任务可复用；拆分判断 / 子任务拆解只做精确匹配
+    async def _plan_pages(self, task: str, page_ids: List[str], *, ai: AsyncOpenAI) -> Dict[str, List[str]]:
         ids_str = ", ".join(page_ids)
-        sys_msg = (
-            "你是任务调度专家，根据【任务】将页面分配给下列 agent："
-            + ", ".join(REGISTRY.keys())
-            + "。格式：agent: id1,id2 或 agent: m-n。仅返回分配结果。"
-        )
-        rsp = client.chat.completions.create(
+        content = await acached_chat(
+            ai, PLAN_TTL,
             model="gpt-4o",
             messages=[
-                {"role": "system", "content": sys_msg},
+                {"role": "system", "content": _PLAN_PAGES_SYS},
                 {"role": "user", "content": f"【任务】{task}\n【页面列表】{ids_str}"},
             ],
+            on_usage=self._usage_logger("页面分配"),
         )
-        return self._parse_page_plan(rsp.choices[0].message.content)
+        return self._parse_page_plan(content)
 
     # ---------- GPT-4o 纯文本任务拆解 ----------
-    def _plan_subtasks(self, task: str) -> Dict[str, List[str]]:
-        sys_msg = (
-            "你是任务调度专家，请把【任务】拆分为多个可并行子任务，并分配给 agent："
-            + ", ".join(REGISTRY.keys())
-            + "。输出每行：agent: 子任务描述。仅返回结果。"
-        )
-        rsp = client.chat.completions.create(
+    @cached_plan(client)
+    async def _plan_subtasks(self, task: str, *, ai: AsyncOpenAI) -> Dict[str, List[str]]:
+        content = await acached_chat(
+            ai, PLAN_TTL,
             model="gpt-4o",               # ← ★ 修正字符串闭合
             messages=[
-                {"role": "system", "content": sys_msg},
+                {"role": "system", "content": _PLAN_SUBTASKS_SYS},
                 {"role": "user", "content": task},
             ],
+            on_usage=self._usage_logger("子任务拆解"),
         )
         mapping: Dict[str, List[str]] = {k: [] for k in REGISTRY}
-        for line in rsp.choices[0].message.content.splitlines():
+        for line in content.splitlines():
             if ":" not in line:
                 continue
             ag, desc = line.split(":", 1)
@@ -128,16 +253,102 @@ class LLMScheduler:
             for part in ids.split(","):
                 if not part:
                     continue
-                if "-" in part:
-                    s, e = part.split("-")
-                    s_idx = int("".join(filter(str.isdigit, s)))
-                    e_idx = int("".join(filter(str.isdigit, e)))
-                    prefix = "".join(filter(str.isalpha, s)) or "page_"
-                    plan[ag] += [f"{prefix}{i}" for i in range(s_idx, e_idx + 1)]
-                else:
+                r = _RANGE_RE.match(part)
+                if r:
+                    prefix = r.group(1) or "page_"
+                    plan[ag] += [f"{prefix}{i}" for i in range(int(r.group(2)), int(r.group(3)) + 1)]
+                elif "-" not in part:          # 无法解析的区间直接丢弃
                     plan[ag].append(part)
         return {k: v for k, v in plan.items() if v}
 
+    # ---------- 并发调用 /infer ----------
+    async def _call_agent(self, http: httpx.AsyncClient, sem: asyncio.Semaphore,
+                          agent: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        async def post():
+            async with sem:              # 退避等待期间不占用并发名额
+                resp = await http.post(REGISTRY[agent], json=payload)
+            if resp.status_code >= 500:
+                resp.raise_for_status()
+            return resp.json()
+        return await _retry(post)
+
+    async def _call_agents(self, calls: List[Tuple[str, Dict[str, Any]]],
+                           on_done: Optional[Callable[[int, Any], None]] = None,
+                           contents: Optional[List[str]] = None) -> List[Any]:
+        """
+        并发发送全部 (agent, payload)；每个端点一个 Semaphore，异常作为结果返回。
+        on_done(i, out) 在第 i 个请求结束时立即回调，不等其余请求。
+        给出 contents（与 calls 一一对应的子任务内容）时，同一 agent 的相同内容只请求一次，结果共享给所有副本。
+        """
+        sems = {ag: asyncio.Semaphore(AGENT_CONCURRENCY) for ag in REGISTRY}
+        inflight: Dict[Tuple[str, bytes], "asyncio.Future[Any]"] = {}
+        async with httpx.AsyncClient(timeout=AGENT_TIMEOUT) as http:
+            def shared(i: int, agent: str, payload: Dict[str, Any]) -> "asyncio.Future[Any]":
+                key = (agent, _content_digest(contents[i])) if contents is not None else None
+                fut = inflight.get(key) if key else None
+                if fut is None:
+                    fut = asyncio.ensure_future(self._call_agent(http, sems[agent], agent, payload))
+                    if key:
+                        inflight[key] = fut
+                return fut
+
+            async def one(i: int, fut: "asyncio.Future[Any]") -> Any:
+                try:
+                    out = await fut          # 重复内容的副本等待同一个请求
+                except Exception as e:
+                    out = e
+                if on_done:
+                    on_done(i, out)
+                return out
+            futs = [shared(i, ag, payload) for i, (ag, payload) in enumerate(calls)]
+            return await asyncio.gather(*[one(i, fut) for i, fut in enumerate(futs)])
+
+    async def _call_agents_batched(self, calls: List[Tuple[str, Dict[str, Any]]],
+                                   on_done: Callable[[int, Any], None]):
+        """按 agent 合并 calls，每个 agent 一次 POST；批量响应拆回各条后逐条回调 on_done(i, out)。"""
+        groups: Dict[str, List[int]] = defaultdict(list)
+        for i, (ag, _) in enumerate(calls):
+            groups[ag].append(i)
+        agents = list(groups)
+        batches = []
+        for ag in agents:
+            first = calls[groups[ag][0]][1]
+            batches.append((ag, {
+                "context_id": first["context_id"],
+                "agent_name": ag,
+                "shared_memory": first["shared_memory"],
+                "items": [{"sub_id": calls[i][1]["sub_id"], "prompt": calls[i][1]["prompt"]} for i in groups[ag]],
+            }))
+
+        def on_batch(j: int, out: Any):
+            idxs = groups[agents[j]]
+            results = out.get("results") if isinstance(out, dict) else None
+            if not isinstance(out, BaseException) and (not isinstance(results, list) or len(results) != len(idxs)):
+                out = ValueError(f"批量响应条数不符：期望 {len(idxs)} 条")
+            for k, i in enumerate(idxs):
+                on_done(i, out if isinstance(out, BaseException) else results[k])
+
+        await self._call_agents(batches, on_batch)
+
+    @staticmethod
+    def _result_text(out: Any) -> str:
+        try:
+            if isinstance(out, BaseException):
+                raise out
+            return out.get("result", "")
+        except Exception as e:
+            return f"[❌ 调用失败] {e}"
+
+    # ---------- OpenAI 提示缓存统计 ----------
+    def _usage_logger(self, name: str) -> Callable[[Any], None]:
+        """返回 on_usage 回调：把本次请求命中 OpenAI 提示缓存的 token 数记入 trace。"""
+        def log(usage: Any):
+            details = getattr(usage, "prompt_tokens_details", None)
+            cached = getattr(details, "cached_tokens", None) or 0
+            self.trace.append({"agent": "scheduler", "subtask": f"{name}（提示缓存）",
+                               "output": f"cached_tokens={cached}/{usage.prompt_tokens}"})
+        return log
+
     # ---------- push helper ----------
     @staticmethod
     def _push(cb: Optional[Callable[[Dict[str, Any]], None]], payload: Dict[str, Any]):
@@ -154,8 +365,30 @@ class LLMScheduler:
         plain_text: Optional[str] = None,
         progress_cb: Optional[Callable[[Dict[str, Any]], None]] = None,
     ) -> Dict[str, Any]:
+        """同步入口：内部在新事件循环中跑 _dispatch。"""
+        return asyncio.run(self._dispatch(context_id, task, pdf_bytes, file_bytes, plain_text, progress_cb))
+
+    async def _dispatch(
+        self,
+        context_id: str,
+        task: str,
+        pdf_bytes: Optional[bytes],
+        file_bytes: Optional[bytes],
+        plain_text: Optional[str],
+        progress_cb: Optional[Callable[[Dict[str, Any]], None]],
+    ) -> Dict[str, Any]:
+        async with AsyncOpenAI(api_key=OPENAI_API_KEY) as ai:
+            return await self._run(ai, context_id, task, pdf_bytes or file_bytes, plain_text, progress_cb)
 
-        pdf_data = pdf_bytes or file_bytes
+    async def _run(
+        self,
+        ai: AsyncOpenAI,
+        context_id: str,
+        task: str,
+        pdf_data: Optional[bytes],
+        plain_text: Optional[str],
+        progress_cb: Optional[Callable[[Dict[str, Any]], None]],
+    ) -> Dict[str, Any]:
 
         # --------  PDF 任务  --------
         if pdf_data:
@@ -164,7 +397,7 @@ class LLMScheduler:
             show_ids = [f"Process {pid}" for pid in page_ids]
             self._push(progress_cb, {"status": "subtasks", "subtasks": show_ids})
 
-            plan = self._plan_pages(task, page_ids)
+            plan = await self._plan_pages(task, page_ids, ai=ai)
             if not plan:
                 plan = {ag: [] for ag in REGISTRY}
                 for idx, pid in enumerate(page_ids):
@@ -173,66 +406,101 @@ class LLMScheduler:
 
             page_map = dict(pages)
             make_prompt = lambda pid: f"【任务指令】{task}\n\n【{pid} 原文】\n{page_map.get(pid, '')}"
+            content_of = lambda pid: page_map.get(pid, "")
             sub_ids_source = plan
 
         # -------- 纯文本 / 指令 ----------- 
         else:
             text = plain_text if plain_text is not None else task
-            if not self._need_split(task):
-                rsp = client.chat.completions.create(
+            # 默认先做拆分判断（gpt-4o-mini、1 token、有缓存），需要拆分时才请求 GPT-4o 规划；
+            # SPECULATIVE_PLAN 下两者并发，退出前总会取消并回收规划任务，异常不会无人接收
+            plan_task = (asyncio.create_task(self._plan_subtasks(task, ai=ai))
+                         if SPECULATIVE_PLAN else None)
+            try:
+                need_split = await self._need_split(task, ai=ai)
+                if need_split:
+                    plan = await (plan_task or self._plan_subtasks(task, ai=ai))
+            finally:
+                if plan_task is not None:              # 已完成时 cancel 无效，gather 仍会取走其异常
+                    plan_task.cancel()
+                    await asyncio.gather(plan_task, return_exceptions=True)
+            if not need_split:
+                md = (await acached_chat_stream(
+                    ai,
+                    lambda delta: self._push(progress_cb, {"status": "summary_delta", "delta": delta}),
+                    ANSWER_TTL,
                     model="gpt-4o",
                     messages=[{"role": "user", "content": f"请以 Markdown 格式完整回答：\n\n{text.strip()}"}],
-                )
-                md = rsp.choices[0].message.content.strip()
+                )).strip()
                 self._push(progress_cb, {"status": "done", "markdown": md})
                 return {"markdown": md, "trace": self.trace}
 
             # 需要拆分
-            plan = self._plan_subtasks(task)
             all_subs = [sub for lst in plan.values() for sub in lst]
             show_subs = [f"Process {s}" for s in all_subs]
             self._push(progress_cb, {"status": "subtasks", "subtasks": show_subs})
             make_prompt = lambda sub: f"【总任务】{task}\n\n【子任务描述】{sub}"
+            content_of = lambda sub: sub
             sub_ids_source = plan
 
-        # ---------- 调用各 agent ----------
+        # ---------- 并发调用各 agent ----------
+        snap = self.memory.get(context_id)     # 所有请求共用调度开始时的 memory 快照
+        calls: List[Tuple[str, str, Dict[str, Any]]] = []
+        contents: List[str] = []
         for ag, keys in sub_ids_source.items():
             for key in keys:
                 sub_name = f"Process {key}"
-                prompt_text = make_prompt(key)
                 self._push(progress_cb, {"status": "assign", "agent": ag, "subtask": sub_name, "output": "Processing"})
-                payload = {
-                    "prompt": prompt_text,
+                calls.append((ag, sub_name, {
+                    "prompt": make_prompt(key),
                     "context_id": context_id,
                     "sub_id": key,
                     "agent_name": ag,
-                    "shared_memory": self.memory.get(context_id),
-                }
-                try:
-                    resp = requests.post(REGISTRY[ag], json=payload, timeout=120)
-                    res_text = resp.json().get("result", "")
-                except Exception as e:
-                    res_text = f"[❌ 调用失败] {e}"
+                    "shared_memory": snap,
+                }))
+                contents.append(content_of(key))
+        texts: List[str] = [""] * len(calls)
+
+        def on_done(i: int, out: Any):
+            # 每个子任务一完成就推送结果，不等全部 agent 返回
+            ag, sub_name, _ = calls[i]
+            texts[i] = self._result_text(out)
+            self._push(progress_cb, {"status": "result", "agent": ag, "subtask": sub_name, "output": texts[i]})
 
-                ag_mem = self.memory.get(context_id).get(ag, {}) or {}
-                ag_mem[sub_name] = res_text
-                self.memory.update(context_id, {ag: ag_mem})
-                self.trace.append({"agent": ag, "subtask": sub_name, "output": res_text})
+        if calls:
+            if AGENT_BATCH:
+                await self._call_agents_batched([(ag, p) for ag, _, p in calls], on_done)
+            else:
+                await self._call_agents([(ag, p) for ag, _, p in calls], on_done, contents)
+
+        # 按计划顺序归并到各 agent 名下，gather 结束后一次性写回 memory
+        bulk: Dict[str, Dict[str, str]] = defaultdict(dict)
+        for (ag, sub_name, _), res_text in zip(calls, texts):
+            bulk[ag][sub_name] = res_text
+            self.trace.append({"agent": ag, "subtask": sub_name, "output": res_text})
+        for ag, ag_mem in bulk.items():
+            prev = snap.get(ag)
+            if isinstance(prev, dict):
+                bulk[ag] = {**prev, **ag_mem}
+        self.memory.update(context_id, bulk)
 
         # ---------- 汇总 ----------
-        collected = "\n\n".join(
-            f"【{ag}】\n" + "\n".join(mem.values())
+        blocks = await _condense(ai, {
+            ag: "\n".join(mem.values())
             for ag, mem in self.memory.get(context_id).items()
             if ag in REGISTRY
-        )
-        rsp = client.chat.completions.create(
+        })
+        collected = "\n\n".join(f"【{ag}】\n" + text for ag, text in blocks.items())
+        summary_md = (await acached_chat_stream(
+            ai,
+            lambda delta: self._push(progress_cb, {"status": "summary_delta", "delta": delta}),
+            ANSWER_TTL,
             model="gpt-4o",
             messages=[{
                 "role": "user",
                 "content": "请综合以下各智能体输出，总结共识、差异并用 Markdown 返回最终建议：\n" + collected
             }]
-        )
-        summary_md = rsp.choices[0].message.content.strip()
+        )).strip()
         self.memory.update(context_id, {"summary": summary_md})
         self.trace.append({"agent": "scheduler", "subtask": "自动总结", "output": summary_md})
 
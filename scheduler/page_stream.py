@@ -0,0 +1,53 @@
+import queue
+import threading
+from typing import Iterator, Optional, Tuple
+
+# ---------- 配置 ----------
+PAGE_QUEUE_SIZE = 4      # 解析线程最多领先消费者的页数
+
+
+class PageStream:
+    """
+    后台线程逐页消费 (page_id, text) 迭代器并写入有界队列（满则阻塞），
+    让 PDF 解析与 GPT 规划、agent 请求重叠进行。
+    - get()：取下一页，解析结束返回 None，解析出错时在此抛出；
+    - close()：放弃剩余页面，通知线程停止并排空队列；可重复调用。
+    """
+
+    def __init__(self, pages: Iterator[Tuple[str, str]], maxsize: int = PAGE_QUEUE_SIZE):
+        self._q: "queue.Queue[Optional[Tuple[str, str]]]" = queue.Queue(maxsize=maxsize)
+        self._stop = threading.Event()
+        self._pages = pages
+        self._done = False
+        self.error: Optional[BaseException] = None
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        try:
+            for page in self._pages:
+                if self._stop.is_set():
+                    break
+                self._q.put(page)
+        except BaseException as e:
+            self.error = e
+        finally:
+            close = getattr(self._pages, "close", None)
+            if close is not None:
+                close()          # 生成器收尾（如关闭 OCR 进程池）
+            self._q.put(None)
+
+    def get(self) -> Optional[Tuple[str, str]]:
+        if self._done:
+            return None
+        page = self._q.get()
+        if page is None:
+            self._done = True
+            if self.error is not None:
+                raise self.error
+        return page
+
+    def close(self):
+        self._stop.set()
+        while not self._done:
+            if self._q.get() is None:
+                self._done = True
@@ -1,11 +1,7 @@
 # test_scheduler.py
-from llm_scheduler import LLMScheduler
+from scheduler.llm_scheduler import LLMScheduler   # 在仓库根目录运行：python test.py
 
 s = LLMScheduler()
-result = s.dispatch(
-    context_id="demo",
-    task="用一句话介绍 Python，并给三个关键特性",
-    plain_text="用一句话介绍 Python，并给三个关键特性"
-)
+# 纯文本任务：dispatch(ctx, task, *, pdf_bytes=None, progress_cb=None)，不带 pdf_bytes 即走文本规划
+result = s.dispatch("demo", "用一句话介绍 Python，并给三个关键特性")
 print(result)
-